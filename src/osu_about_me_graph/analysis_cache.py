@@ -0,0 +1,106 @@
+import numpy
+
+import hashlib
+import json
+import sqlite3
+import time
+import typing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    algorithm TEXT NOT NULL,
+    username TEXT NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (algorithm, username)
+);
+
+CREATE TABLE IF NOT EXISTS cold_iterations (
+    algorithm TEXT PRIMARY KEY,
+    iterations INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS results (
+    algorithm TEXT PRIMARY KEY,
+    result_key TEXT NOT NULL,
+    result TEXT NOT NULL,
+    elapsed_sec REAL NOT NULL,
+    computed_at REAL NOT NULL
+);
+"""
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def make_result_key(graph_fingerprint: str, params: dict) -> str:
+    """
+    Key for a result computed on a graph with the given fingerprint, using the given (JSON-serializable) parameters.
+    """
+    return hashlib.sha256((graph_fingerprint + json.dumps(params, sort_keys=True)).encode("utf-8")).hexdigest()
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+class AnalysisCache:
+    """
+    SQLite-backed storage for results of graph analysis runs.
+    * scores: final score of every user for iterative algorithms (PageRank, HITS), used as the starting point of the
+      next run; consecutive graphs barely differ, so this converges in far fewer iterations than a uniform start.
+    * cold_iterations: iterations each algorithm took the last time it was started uniformly, to compare against.
+    * results: latest result of each algorithm, keyed by a fingerprint of the graph and the algorithm's parameters, so
+      that runs on an unchanged graph don't compute anything again.
+    """
+    def __init__(self, filename: str):
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def load_scores(self, algorithm: str, usernames: list[str]) -> typing.Union[numpy.ndarray, None]:
+        """
+        Return the last saved scores of algorithm, in the order of usernames. Users without a saved score get the mean
+        of the others. Returns None if no user has a saved score.
+        """
+        saved_scores = dict(self.conn.execute("SELECT username, score FROM scores WHERE algorithm = ?", (algorithm,)))
+        scores = numpy.array([saved_scores.get(username, numpy.nan) for username in usernames], dtype=numpy.float64)
+
+        is_missing = numpy.isnan(scores)
+        if is_missing.all():
+            return None
+
+        scores[is_missing] = scores[~is_missing].mean()
+        return scores
+
+    def save_scores(self, algorithm: str, scores: list[tuple[str, float]]) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM scores WHERE algorithm = ?", (algorithm,))
+            self.conn.executemany(
+                "INSERT INTO scores (algorithm, username, score) VALUES (?, ?, ?)",
+                [(algorithm, username, score) for username, score in scores]
+            )
+
+    def get_cold_iterations(self, algorithm: str) -> typing.Union[int, None]:
+        row = self.conn.execute("SELECT iterations FROM cold_iterations WHERE algorithm = ?", (algorithm,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_cold_iterations(self, algorithm: str, iterations: int) -> None:
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO cold_iterations (algorithm, iterations) VALUES (?, ?)", (algorithm, iterations))
+
+    def get_result(self, algorithm: str, result_key: str) -> typing.Union[tuple[typing.Any, float], None]:
+        """
+        Return (result, seconds it took to compute) of algorithm if it was last computed with the same result key.
+        Results come back as decoded from JSON; tuples and sets are turned into lists.
+        """
+        row = self.conn.execute("SELECT result, elapsed_sec FROM results WHERE algorithm = ? AND result_key = ?", (algorithm, result_key)).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else None
+
+    def put_result(self, algorithm: str, result_key: str, result: typing.Any, elapsed_sec: float) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (algorithm, result_key, result, elapsed_sec, computed_at) VALUES (?, ?, ?, ?, ?)",
+                (algorithm, result_key, json.dumps(result, default=sorted), elapsed_sec, time.time())
+            )
+
+#################################################################################################################################################
+#################################################################################################################################################
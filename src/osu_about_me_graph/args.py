@@ -14,7 +14,28 @@ def parse_arguments() -> None:
     # Add arguments
     parser.add_argument(
         "--big-nodes-closer",
-        help="pull highly mentioned users closer to the center rather than pushing them away",
+        help="deprecated and has no effect; the layout, like networkx, ignores which way the center weights point, so users are always pulled in",
+        action="store_true",
+        required=False
+    )
+
+    parser.add_argument(
+        "--fresh-layout",
+        help="lay out the graph from scratch rather than starting from the node positions saved by the last run",
+        action="store_true",
+        required=False
+    )
+
+    parser.add_argument(
+        "--incremental",
+        help="only request users that aren't in the user store (plus a rotating slice of stale ones) from osu!API",
+        action="store_true",
+        required=False
+    )
+
+    parser.add_argument(
+        "--multilevel-layout",
+        help="lay out the graph coarsest-first (collapsing heavily connected users) and refine level by level; better global structure in fewer iterations",
         action="store_true",
         required=False
     )
@@ -40,6 +61,13 @@ def parse_arguments() -> None:
         required=False
     )
 
+    parser.add_argument(
+        "--resume",
+        help="continue an interrupted osu!API scrape from its checkpoint; only missing users will be requested",
+        action="store_true",
+        required=False
+    )
+
     parser.add_argument(
         "--save-json",
         help="save graph data to cytoscape-compatible json file",
@@ -62,6 +90,13 @@ def parse_arguments() -> None:
 
 
 
+    parser.add_argument(
+        "--analysis-workers",
+        help="number of processes to run graph analysis algorithms with; each holds its own copy of the graph, so memory use grows with it (default: up to 4) [int > 0]",
+        type=int,
+        required=False
+    )
+
     parser.add_argument(
         "--arrow-size",
         help="size of arrows on edges in the graph [int > 0]",
@@ -69,6 +104,13 @@ def parse_arguments() -> None:
         required=False
     )
 
+    parser.add_argument(
+        "--betweenness-samples",
+        help="approximate betweenness centrality from this many randomly picked users rather than all of them [int >= 2]",
+        type=int,
+        required=False
+    )
+
     parser.add_argument(
         "--centrality-weight",
         help="gravity between all users and the center; higher means closer to the center [float]",
@@ -125,6 +167,13 @@ def parse_arguments() -> None:
         required=False
     )
 
+    parser.add_argument(
+        "--fp-sort-by",
+        help="order of users in false-positives report; suspicion means mentions per follower [mentions, suspicion]",
+        type=str,
+        required=False
+    )
+
     parser.add_argument(
         "--gamemode",
         help="osu! gamemode [osu, taiko, mania, catch]",
@@ -139,6 +188,13 @@ def parse_arguments() -> None:
         required=False
     )
 
+    parser.add_argument(
+        "--incremental-refresh-percent",
+        help="percentage of stored users to refetch on incremental runs, least recently fetched first [float 0-100]",
+        type=float,
+        required=False
+    )
+
     parser.add_argument(
         "--iterations",
         help="number of graph iterations; higher means better convergence [int > 0]",
@@ -188,6 +244,13 @@ def parse_arguments() -> None:
         required=False,
     )
 
+    parser.add_argument(
+        "--parse-workers",
+        help="number of processes to parse about me pages with [int > 0]",
+        type=int,
+        required=False
+    )
+
     parser.add_argument(
         "--rank-range-clustering-weight",
         help="gravity between users in the same rank; higher means closer together [float]",
@@ -209,6 +272,27 @@ def parse_arguments() -> None:
         required=False
     )
 
+    parser.add_argument(
+        "--report-top-k",
+        help="only list this many top users per score in the graph analysis report; every score is still written to its CSV [int > 0]",
+        type=int,
+        required=False
+    )
+
+    parser.add_argument(
+        "--request-burst",
+        help="maximum number of osu!API requests that can be fired at once after idling [int > 0]",
+        type=int,
+        required=False
+    )
+
+    parser.add_argument(
+        "--requests-per-sec",
+        help="average number of osu!API requests per second [float > 0]",
+        type=float,
+        required=False
+    )
+
     parser.add_argument(
         "--spring-force",
         help="spacing between nodes; higher means further apart [float]",
@@ -227,7 +311,14 @@ def parse_arguments() -> None:
     global ARGS
     ARGS = parser.parse_args()
 
+    # Warn about deprecated arguments
+    if ARGS.big_nodes_closer:
+        print("--big-nodes-closer is deprecated and has no effect")
+
     # Set defaults
+    if ARGS.analysis_workers is None:
+        ARGS.analysis_workers = min(4, os.cpu_count() or 1)
+
     if ARGS.arrow_size is None:
         ARGS.arrow_size = 10
 
@@ -255,12 +346,18 @@ def parse_arguments() -> None:
     if ARGS.fp_mentions_top_percentile is None:
         ARGS.fp_mentions_top_percentile = 5.0
 
+    if ARGS.fp_sort_by is None:
+        ARGS.fp_sort_by = "mentions"
+
     if ARGS.gamemode is None:
         ARGS.gamemode = "osu"
 
     if ARGS.image_width is None:
         ARGS.image_width = 100
 
+    if ARGS.incremental_refresh_percent is None:
+        ARGS.incremental_refresh_percent = 10.0
+
     if ARGS.iterations is None:
         ARGS.iterations = 150
 
@@ -282,6 +379,9 @@ def parse_arguments() -> None:
     if ARGS.num_users is None:
         ARGS.num_users = 1000
 
+    if ARGS.parse_workers is None:
+        ARGS.parse_workers = 1
+
     if ARGS.rank_range_clustering_weight is None:
         ARGS.rank_range_clustering_weight = 100.0
 
@@ -291,6 +391,14 @@ def parse_arguments() -> None:
     if ARGS.rank_range_size is None:
         ARGS.rank_range_size = 50
 
+    if ARGS.request_burst is None:
+        ARGS.request_burst = 10
+
+    # osu!API v2 docs (https://osu.ppy.sh/docs/index.html#introduction) specify ratelimit of 1200 requests/min (20 requests/sec).
+    # Be nice to peppy by staying well under that.
+    if ARGS.requests_per_sec is None:
+        ARGS.requests_per_sec = 10.0
+
     if ARGS.spring_force is None:
         ARGS.spring_force = 2.5
 
@@ -306,10 +414,18 @@ def parse_arguments() -> None:
     # Validate inputs
     do_exit = False
     error_messages = ""
+    if ARGS.analysis_workers <= 0:
+        error_messages += "Analysis workers must be greater than zero!\n"
+        do_exit = True
+
     if ARGS.arrow_size <= 0:
         error_messages += "Arrow size must be greater than zero!\n"
         do_exit = True
 
+    if ARGS.betweenness_samples is not None and ARGS.betweenness_samples < 2:
+        error_messages += "Betweenness samples must be at least two!\n"
+        do_exit = True
+
     if ARGS.dpi <= 0:
         error_messages += "DPI must be greater than zero!\n"
         do_exit = True
@@ -338,6 +454,10 @@ def parse_arguments() -> None:
         error_messages += "FP mentions top percentile must be within [0, 100]!\n"
         do_exit = True
 
+    if ARGS.fp_sort_by not in ["mentions", "suspicion"]:
+        error_messages += "FP sort by must be one of mentions or suspicion!\n"
+        do_exit = True
+
     if ARGS.gamemode not in ["osu", "taiko", "mania", "catch"]:
         error_messages += "Gamemode must be one of osu, taiko, mania, or catch!\n"
         do_exit = True
@@ -346,6 +466,10 @@ def parse_arguments() -> None:
         error_messages += "Image width must be greater than zero!\n"
         do_exit = True
 
+    if ARGS.incremental_refresh_percent < 0 or ARGS.incremental_refresh_percent > 100:
+        error_messages += "Incremental refresh percent must be within [0, 100]!\n"
+        do_exit = True
+
     if ARGS.iterations <= 0:
         error_messages += "Iterations must be greater than zero!\n"
         do_exit = True
@@ -382,6 +506,10 @@ def parse_arguments() -> None:
         error_messages += "Number of users must be within [1, 10000]!\n"
         do_exit = True  
 
+    if ARGS.parse_workers <= 0:
+        error_messages += "Parse workers must be greater than zero!\n"
+        do_exit = True
+
     if ARGS.start_rank < 1 or ARGS.start_rank > 10000:
         error_messages += "Start rank must be within [1, 10000]!\n"
         do_exit = True
@@ -390,6 +518,18 @@ def parse_arguments() -> None:
         error_messages += f"Cannot pull users past rank 10000! Start rank = {ARGS.start_rank}, number of users = {ARGS.num_users}...\n"
         do_exit = True
 
+    if ARGS.report_top_k is not None and ARGS.report_top_k <= 0:
+        error_messages += "Report top k must be greater than zero!\n"
+        do_exit = True
+
+    if ARGS.request_burst <= 0:
+        error_messages += "Request burst must be greater than zero!\n"
+        do_exit = True
+
+    if ARGS.requests_per_sec <= 0:
+        error_messages += "Requests per second must be greater than zero!\n"
+        do_exit = True
+
     if ARGS.rank_range_size <= 0:
         error_messages += "Rank range size must be greater than zero!\n"
         do_exit = True
@@ -1,4 +1,14 @@
+import asyncio
 import collections
+import hashlib
+import mmap
+import os
+import struct
+import time
+import typing
+
+import numpy
+import scipy.sparse
 
 #################################################################################################################################################
 #################################################################################################################################################
@@ -7,15 +17,21 @@ class DirectedGraph:
     """
     Adjacency list for a directed graph.
     In degree values stored separately for faster access.
+    Reverse adjacency (vertex -> {in-neighbour: number of times the edge was added}) is kept alongside, so that in-edge
+    lookups and removals only touch the vertex's own neighbours.
     """
     def __init__(self):
         self.adj = collections.defaultdict(set)
+        self.radj = collections.defaultdict(dict)
         self.in_degrees = collections.defaultdict(int)
 
     def add_vertex(self, vertex: str) -> None:
         if vertex not in self.adj:
             self.adj[vertex] = set()
 
+        if vertex not in self.radj:
+            self.radj[vertex] = {}
+
         if vertex not in self.in_degrees:
             self.in_degrees[vertex] = 0
 
@@ -24,16 +40,47 @@ class DirectedGraph:
         if to_vertex not in self.adj:
             self.adj[to_vertex] = set()
 
+        if from_vertex not in self.radj:
+            self.radj[from_vertex] = {}
+        self.radj[to_vertex][from_vertex] = self.radj[to_vertex].get(from_vertex, 0) + 1
+
+        if from_vertex not in self.in_degrees:
+            self.in_degrees[from_vertex] = 0
         if to_vertex not in self.in_degrees:
             self.in_degrees[to_vertex] = 0
         self.in_degrees[to_vertex] += 1
 
+    def remove_edge(self, from_vertex: str, to_vertex: str) -> None:
+        """
+        Remove edge (along with every time it was added) from the graph. Both vertices are kept.
+        """
+        if to_vertex not in self.adj.get(from_vertex, ()):
+            raise KeyError(f"Edge {from_vertex} -> {to_vertex} does not exist!")
+
+        self.adj[from_vertex].remove(to_vertex)
+        self.in_degrees[to_vertex] -= self.radj[to_vertex].pop(from_vertex)
+
+    def remove_vertex(self, vertex: str) -> None:
+        """
+        Remove vertex and all of its in and out edges from the graph.
+        """
+        if vertex not in self.adj:
+            raise KeyError(f"Vertex {vertex} does not exist!")
+
+        for to_vertex in list(self.adj[vertex]):
+            self.remove_edge(vertex, to_vertex)
+        for from_vertex in list(self.radj[vertex]):
+            self.remove_edge(from_vertex, vertex)
+
+        del self.adj[vertex]
+        del self.radj[vertex]
+        del self.in_degrees[vertex]
+
     def get_in_edges(self, to_vertex: str) -> set:
-        in_edges = set()
-        for from_vertex, to_vertices in self.adj.items():
-            if to_vertex in to_vertices:
-                in_edges.add((from_vertex, to_vertex))
-        return in_edges
+        return {(from_vertex, to_vertex) for from_vertex in self.radj.get(to_vertex, ())}
+
+    def freeze(self) -> "FrozenGraph":
+        return FrozenGraph.from_graph(self)
 
     def print_graph(self) -> None:
         if not self.adj:
@@ -49,76 +96,464 @@ class DirectedGraph:
         for vertex in sorted(self.in_degrees.keys()):
             print(f"    {vertex}: {self.in_degrees[vertex]}")
 
+class FrozenGraph:
+    """
+    Immutable, integer-indexed form of a DirectedGraph for the stages that only read it.
+    Vertex i is usernames[i]; its out-neighbours are indices[indptr[i]:indptr[i + 1]] (CSR), in the same order as in
+    DirectedGraph.adj. in_degrees holds the DirectedGraph's in degree of each vertex.
+    """
+    def __init__(self, usernames: list[str], indptr: numpy.ndarray, indices: numpy.ndarray, in_degrees: numpy.ndarray):
+        self.usernames = usernames
+        self.username_to_id = {username: i for i, username in enumerate(usernames)}
+        self.indptr = indptr
+        self.indices = indices
+        self.in_degrees = in_degrees
 
-#################################################################################################################################################
-#################################################################################################################################################
+    @classmethod
+    def from_graph(cls, graph: DirectedGraph) -> "FrozenGraph":
+        usernames = list(graph.adj.keys())
+        username_to_id = {username: i for i, username in enumerate(usernames)}
+
+        indptr = numpy.zeros(len(usernames) + 1, dtype=numpy.int32)
+        indptr[1:] = numpy.cumsum([len(graph.adj[username]) for username in usernames])
+        indices = numpy.fromiter(
+            (username_to_id[to_vertex] for username in usernames for to_vertex in graph.adj[username]),
+            dtype=numpy.int32,
+            count=indptr[-1]
+        )
+        in_degrees = numpy.array([graph.in_degrees[username] for username in usernames], dtype=numpy.int32)
+
+        return cls(usernames, indptr, indices, in_degrees)
+
+    @property
+    def num_vertices(self) -> int:
+        return len(self.usernames)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.indices)
 
-class TrieNode:
+    @property
+    def out_degrees(self) -> numpy.ndarray:
+        return numpy.diff(self.indptr)
+
+    def get_out_neighbors(self, vertex_id: int) -> numpy.ndarray:
+        return self.indices[self.indptr[vertex_id]:self.indptr[vertex_id + 1]]
+
+    def get_edges(self) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Return (source ids, target ids) of every edge, in CSR order.
+        """
+        return numpy.repeat(numpy.arange(self.num_vertices, dtype=numpy.int32), self.out_degrees), self.indices
+
+    def fingerprint(self) -> str:
+        """
+        Hash of the (sorted) usernames and edges; the same for equal graphs, regardless of the order anything was added in.
+        """
+        (sources, targets) = self.get_edges()
+        usernames = self.usernames
+        edges = sorted(zip([usernames[i] for i in sources.tolist()], [usernames[i] for i in targets.tolist()]))
+
+        digest = hashlib.sha256()
+        digest.update("\n".join(sorted(usernames)).encode("utf-8"))
+        digest.update(b"\n\n")
+        digest.update("\n".join(f"{source}\t{target}" for source, target in edges).encode("utf-8"))
+        return digest.hexdigest()
+
+    def to_scipy(self, dtype: numpy.dtype = numpy.float64) -> scipy.sparse.csr_array:
+        """
+        Adjacency matrix (A[i, j] = 1 iff i mentions j) sharing indptr/indices with this graph.
+        """
+        data = numpy.ones(self.num_edges, dtype=dtype)
+        return scipy.sparse.csr_array((data, self.indices, self.indptr), shape=(self.num_vertices, self.num_vertices), copy=False)
+
+class MentionIndex:
     """
-    Prefix tree node.
+    Where the edges of a mentions graph came from. For every (mentioner, mentioned) edge, stores each alias of the
+    mentioned user found on the mentioner's about me page, with its offset in the (lowercased) page and a snippet of
+    the line it was found on.
     """
     def __init__(self):
-        self.children = {}
-        self.is_end_of_word = False
+        self.mentions = {}
+        self.mentioners = collections.defaultdict(list)
+
+    def add_mention(self, mentioner: str, mentioned: str, alias: str, offset: int, snippet: str) -> None:
+        edge = (mentioner, mentioned)
+        if edge not in self.mentions:
+            self.mentions[edge] = []
+            self.mentioners[mentioned].append(mentioner)
+        self.mentions[edge].append((alias, offset, snippet))
+
+    def get_mentions(self, mentioner: str, mentioned: str) -> list[tuple[str, int, str]]:
+        """
+        Return (alias, offset, snippet) of every mention of mentioned on mentioner's page, ordered by alias.
+        """
+        return self.mentions.get((mentioner, mentioned), [])
+
+    def get_mentioners(self, mentioned: str) -> list[str]:
+        return self.mentioners.get(mentioned, [])
+
+    def __len__(self) -> int:
+        return sum(len(mentions) for mentions in self.mentions.values())
 
-class Trie:
+class UserIndex:
     """
-    Prefix tree.
+    Users of a run, indexed by current username, alias and user ID. Built once and shared by every stage.
+    Users are expected in follower count (descending), then rank (ascending) order. Someone's current username could
+    be another's past username; in that case (or if a username appears twice), lookups return the user that comes first.
+    """
+    def __init__(self, users: list[dict]):
+        self.users = users
+        self.by_username = {}
+        self.by_alias = {}
+        self.by_user_id = {}
+
+        for user in users:
+            self.by_user_id[user["user_id"]] = user
+            self.by_username.setdefault(user["current_username"], user)
+            for alias in self.get_aliases(user):
+                self.by_alias.setdefault(alias, user)
+
+    @staticmethod
+    def get_aliases(user: dict) -> list[str]:
+        """
+        Return every alias of user: their current username, past usernames and "users/<UID>".
+        The latter accounts for collabs that use user ID instead of username.
+        See: https://github.com/mbalsdon/osu-about-me-graph/issues/18
+        """
+        return [user["current_username"]] + user["previous_usernames"] + [f"users/{user['user_id']}"]
+
+    def get_by_username(self, current_username: str) -> typing.Union[dict, None]:
+        return self.by_username.get(current_username)
+
+    def get_by_alias(self, alias: str) -> typing.Union[dict, None]:
+        return self.by_alias.get(alias)
+
+    def get_by_user_id(self, user_id: int) -> typing.Union[dict, None]:
+        return self.by_user_id.get(user_id)
+
+    def __iter__(self) -> typing.Iterator[dict]:
+        return iter(self.users)
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+class CompactTrie:
     """
+    Prefix tree of words, stored in a handful of flat integer arrays instead of one dict per node:
+        * edges of state s are edge_chars/edge_targets[offsets[s]:offsets[s + 1]], sorted by character code point
+        * word_lengths: length of the word ending at each state (0 if none)
+    States are numbered breadth-first, so edges sorted by (state, character) are also sorted by the state they lead to.
+
+    Small in memory and when pickled, and can be saved to a file that later runs (or worker processes) memory-map
+    instead of rebuilding the tree.
+
+    Words are only matched at word boundaries, so documents are only walked down the tree from their start and from
+    after every non-alphanumeric character. All of these walks take their steps at once, as NumPy lookups of
+    (state, character) pairs; a batch of documents is searched as a single one. Most walks are short, so most lookups
+    are of ASCII characters from the shallowest states, which get a dense table of their edges (up to
+    MAX_DENSE_EDGES entries); other lookups search the sorted edges.
+    """
+    MAGIC = b"OAMGCT01"
+    HEADER_FORMAT = "=8s64sII"
+
+    # Edge keys are state << CHAR_BITS | character code point
+    CHAR_BITS = 21
+
+    # 4 bytes each, so at most 4 MiB per process
+    MAX_DENSE_EDGES = 1 << 20
+
+    # Whether each ASCII character is alphanumeric (by str.isalnum); other characters are looked up as they come
+    ASCII_ALNUM = numpy.array([chr(code).isalnum() for code in range(128)])
+
     def __init__(self):
-        self.root = TrieNode()
+        self.offsets = numpy.zeros(2, dtype=numpy.uint32)
+        self.edge_chars = numpy.zeros(0, dtype=numpy.uint32)
+        self.edge_targets = numpy.zeros(0, dtype=numpy.uint32)
+        self.word_lengths = numpy.zeros(1, dtype=numpy.uint32)
+
+        self.pending_words = []
+        self.mmap = None
+        self.reset_lookups()
+
+    def reset_lookups(self) -> None:
+        # Computed on first use, so that trees which are only built, saved or pickled don't pay for them
+        self.edge_keys = None
+        self.num_dense_states = 0
+        self.dense_edges = None
 
     def insert(self, word: str) -> None:
-        node = self.root
-        for char in word.lower():
-            if char not in node.children:
-                node.children[char] = TrieNode()
-            node = node.children[char]
-        node.is_end_of_word = True
+        self.pending_words.append(word)
 
-    def find_names_in_document(self, document: str) -> set[str]:
+    def build(self) -> None:
+        """
+        Compile inserted words (along with any already in the tree).
+        Called automatically by find methods after words were inserted.
+        The words are sorted and padded into the rows of a code point matrix. A word adds a state for each of its
+        prefixes that is longer than the prefix it shares with the word before it, so every depth of the tree is built
+        at once from the rows that add a state there.
+        """
+        words = sorted({word.lower() for word in self.get_all_words() + self.pending_words} - {""})
+        self.pending_words = []
+        self.mmap = None
+        self.reset_lookups()
+        if not words:
+            self.__init__()
+            return
+
+        codes = numpy.array(words).view(numpy.uint32).reshape(len(words), -1)
+        lengths = numpy.array([len(word) for word in words])
+        shared_lengths = numpy.concatenate(([0], numpy.argmax(codes[1:] != codes[:-1], axis=1)))
+
+        # State of each word's prefix at the previous depth
+        prefix_states = numpy.zeros(len(words), dtype=numpy.int64)
+        num_states = 1
+        (parents, edge_chars, word_lengths) = ([], [], [numpy.zeros(1, dtype=numpy.int64)])
+        for depth in range(1, codes.shape[1] + 1):
+            adds_state = (shared_lengths < depth) & (lengths >= depth)
+            rows = numpy.flatnonzero(adds_state)
+            parents.append(prefix_states[rows])
+            edge_chars.append(codes[rows, depth - 1])
+            word_lengths.append(numpy.where(lengths[rows] == depth, depth, 0))
+
+            # Words sharing a prefix of this length are contiguous, starting at the one that added its state
+            prefix_states = num_states + numpy.cumsum(adds_state) - 1
+            num_states += len(rows)
+
+        parents = numpy.concatenate(parents)
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(parents, minlength=num_states)))).astype(numpy.uint32)
+        self.edge_chars = numpy.concatenate(edge_chars).astype(numpy.uint32)
+        self.edge_targets = numpy.arange(1, num_states, dtype=numpy.uint32)
+        self.word_lengths = numpy.concatenate(word_lengths).astype(numpy.uint32)
+
+    def init_lookups(self) -> None:
+        parents = numpy.repeat(numpy.arange(len(self.word_lengths), dtype=numpy.int64), numpy.diff(self.offsets))
+        self.edge_keys = (parents << self.CHAR_BITS) | self.edge_chars
+
+        # Rows of 128 ASCII characters for the first (shallowest) states; 0 where there is no edge
+        self.num_dense_states = min(len(self.word_lengths), self.MAX_DENSE_EDGES // 128)
+        is_dense = (parents < self.num_dense_states) & (self.edge_chars < 128)
+        self.dense_edges = numpy.zeros(self.num_dense_states * 128, dtype=numpy.uint32)
+        self.dense_edges[parents[is_dense] * 128 + self.edge_chars[is_dense]] = self.edge_targets[is_dense]
+
+    def follow_edges(self, states: numpy.ndarray, chars: numpy.ndarray) -> numpy.ndarray:
+        """
+        Return the state that each state's edge on the corresponding character leads to, or 0 if it has none.
+        """
+        is_dense = (states < self.num_dense_states) & (chars < 128)
+        if is_dense.all():
+            return self.dense_edges[states * 128 + chars].astype(numpy.int64)
+
+        next_states = numpy.zeros(len(states), dtype=numpy.int64)
+        next_states[is_dense] = self.dense_edges[states[is_dense] * 128 + chars[is_dense]]
+
+        is_sparse = ~is_dense
+        keys = (states[is_sparse] << self.CHAR_BITS) | chars[is_sparse]
+        edges = numpy.minimum(numpy.searchsorted(self.edge_keys, keys), len(self.edge_keys) - 1)
+        next_states[is_sparse] = numpy.where(self.edge_keys[edges] == keys, self.edge_targets[edges], 0)
+        return next_states
+
+    def find_matches_many(self, documents: list[str]) -> list[list[tuple[int, int]]]:
         """
-        Return set of names from prefix tree that appear in given document.
+        Return (start index, length) of every occurrence of every word in each of the (lowercased) documents that is
+        not part of a larger alphanumeric sequence, i.e. that starts and ends at the document's edges or next to
+        non-alphanumeric characters; sorted by start index, then length. Matched words are
+        document.lower()[start:start + length]; see first_longest_matches.
         """
-        document = document.lower()
-        found_names = set()
+        if self.pending_words:
+            self.build()
+        if not len(self.edge_chars):
+            return [[] for _ in documents]
+        if self.edge_keys is None:
+            self.init_lookups()
+
+        # Documents are joined by (and end in) a character that no word has, so that no walk runs past a document
+        pages = [document.lower() for document in documents]
+        codes = numpy.frombuffer(("\0".join(pages) + "\0").encode("utf-32-le", "surrogatepass"), dtype=numpy.uint32).astype(numpy.int64)
+        page_starts = numpy.cumsum([0] + [len(page) + 1 for page in pages[:-1]])
+
+        is_alnum = self.ASCII_ALNUM[numpy.minimum(codes, 127)]
+        non_ascii = numpy.flatnonzero(codes >= 128)
+        if len(non_ascii):
+            (unique_codes, inverse) = numpy.unique(codes[non_ascii], return_inverse=True)
+            is_alnum[non_ascii] = numpy.array([chr(code).isalnum() for code in unique_codes.tolist()], dtype=bool)[inverse]
 
-        for i in range(len(document)):
-            if i > 0 and document[i-1].isalnum():
-                continue
+        starts = numpy.flatnonzero(numpy.concatenate(([True], ~is_alnum[:-1])))
+        states = numpy.zeros(len(starts), dtype=numpy.int64)
+        positions = starts
+        (match_starts, match_lengths) = ([numpy.zeros(0, dtype=numpy.int64)], [numpy.zeros(0, dtype=numpy.int64)])
+        while len(starts):
+            states = self.follow_edges(states, codes[positions])
+            has_edge = states != 0
+            (starts, states, positions) = (starts[has_edge], states[has_edge], positions[has_edge] + 1)
 
-            node = self.root
-            j = i
+            is_match = (self.word_lengths[states] > 0) & ~is_alnum[positions]
+            if is_match.any():
+                match_starts.append(starts[is_match])
+                match_lengths.append((positions - starts)[is_match])
 
-            matched_name = None
+        match_starts = numpy.concatenate(match_starts)
+        match_lengths = numpy.concatenate(match_lengths)
+        order = numpy.lexsort((match_lengths, match_starts))
+        (match_starts, match_lengths) = (match_starts[order], match_lengths[order])
 
-            while j < len(document) and document[j] in node.children:
-                node = node.children[document[j]]
-                j += 1
+        match_pages = numpy.searchsorted(page_starts, match_starts, side="right") - 1
+        spans = list(zip((match_starts - page_starts[match_pages]).tolist(), match_lengths.tolist()))
+        ends = numpy.cumsum(numpy.bincount(match_pages, minlength=len(pages))).tolist()
+        return [spans[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+    def find_matches(self, document: str) -> list[tuple[int, int]]:
+        """
+        Same as find_matches_many, for a single document.
+        """
+        return self.find_matches_many([document])[0]
 
-                if node.is_end_of_word:
-                    if j == len(document) or not document[j].isalnum():
-                        matched_name = document[i:j]
+    @staticmethod
+    def first_longest_matches(document: str, matches: list[tuple[int, int]]) -> dict[str, int]:
+        """
+        Reduce (start index, length) matches in the lowercased document to the words matched, keeping only the longest
+        match at each start index; maps each word to the first start index it was matched at.
+        Only these words are sliced out of the document.
+        """
+        longest = {}
+        for start, length in matches:
+            if length > longest.get(start, 0):
+                longest[start] = length
 
-            if matched_name:
-                found_names.add(matched_name)
+        first_starts = {}
+        for start in sorted(longest):
+            first_starts.setdefault(document[start:start + longest[start]], start)
+        return first_starts
 
-        return found_names
+    def find_names_in_document(self, document: str) -> set[str]:
+        """
+        Return set of names from the tree that appear in given document.
+        Where names overlap at the same position, only the longest is returned.
+        """
+        matches = self.find_matches(document)
+        return set(self.first_longest_matches(document.lower(), matches)) if matches else set()
 
     def get_all_words(self) -> list[str]:
         """
-        Return all words stored in the prefix tree.
+        Return all words stored in the tree.
         """
+        (offsets, edge_chars, edge_targets, word_lengths) = [values.tolist() for values in self.arrays()]
         words = []
-        def dfs(node: TrieNode, current_word: str) -> None:
-            if node.is_end_of_word:
-                words.append(current_word)
+        stack = [(0, "")]
+        while stack:
+            state, word = stack.pop()
+            if word_lengths[state]:
+                words.append(word)
+            for i in range(offsets[state], offsets[state + 1]):
+                stack.append((edge_targets[i], word + chr(edge_chars[i])))
+        return sorted(words)
 
-            for char, child in node.children.items():
-                dfs(child, current_word + char)
+    def arrays(self) -> list[numpy.ndarray]:
+        return [self.offsets, self.edge_chars, self.edge_targets, self.word_lengths]
 
-        dfs(self.root, "")
-        return sorted(words)
+    def save(self, filename: str, fingerprint: str = "") -> None:
+        """
+        Write the tree to a file, tagged with an (up to 64 character) fingerprint of its words.
+        The file is written next to filename first and then moved over it, since other processes may still have the old
+        one memory-mapped (truncating a mapped file can crash them).
+        """
+        if self.pending_words:
+            self.build()
+
+        temp_filename = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(temp_filename, "wb") as f:
+                f.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, fingerprint.encode("ascii"), len(self.word_lengths), len(self.edge_chars)))
+                for values in self.arrays():
+                    f.write(numpy.asarray(values, dtype=numpy.uint32).tobytes())
+            os.replace(temp_filename, filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    @classmethod
+    def load(cls, filename: str, fingerprint: str = "") -> typing.Union["CompactTrie", None]:
+        """
+        Memory-map a tree written by save. Returns None if the file doesn't exist, is empty or cut short (e.g. by a crash
+        of a version that wrote it in place), isn't a tree written on a machine with the same byte order, or doesn't have
+        the given fingerprint.
+        """
+        header_size = struct.calcsize(cls.HEADER_FORMAT)
+        try:
+            if os.path.getsize(filename) < header_size:
+                return None
+            with open(filename, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        magic, file_fingerprint, num_states, num_edges = struct.unpack_from(cls.HEADER_FORMAT, mapped)
+        lengths = [num_states + 1, num_edges, num_edges, num_states]
+        if (
+            magic != cls.MAGIC
+            or file_fingerprint.rstrip(b"\0") != fingerprint.encode("ascii")
+            or len(mapped) != header_size + 4 * sum(lengths)
+        ):
+            mapped.close()
+            return None
+
+        trie = cls()
+        views = []
+        position = header_size
+        for length in lengths:
+            views.append(numpy.frombuffer(mapped, dtype=numpy.uint32, count=length, offset=position))
+            position += 4 * length
+
+        (trie.offsets, trie.edge_chars, trie.edge_targets, trie.word_lengths) = views
+        trie.mmap = mapped
+        return trie
+
+    def __getstate__(self) -> dict:
+        if self.pending_words:
+            self.build()
+        return {"arrays": [numpy.asarray(values, dtype=numpy.uint32).tobytes() for values in self.arrays()]}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+        (self.offsets, self.edge_chars, self.edge_targets, self.word_lengths) = [
+            numpy.frombuffer(values, dtype=numpy.uint32) for values in state["arrays"]
+        ]
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+class TokenBucket:
+    """
+    Token bucket ratelimiter shared between coroutines.
+    Tokens refill continuously at `rate` per second, up to `burst` tokens.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self) -> None:
+        """
+        Wait until a token is available, then take it.
+        Waiters are served in FIFO order since asyncio.Lock is fair.
+        """
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1.0:
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1.0
 
 #################################################################################################################################################
 #################################################################################################################################################
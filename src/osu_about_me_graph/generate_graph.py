@@ -1,224 +1,231 @@
 from . import classes
+from . import layout
+from . import layout_cache
 
 import matplotlib.axes
 import matplotlib.figure
 import matplotlib.patches
 import matplotlib.pyplot
 import networkx
+import numpy
 import PIL.Image
 import PIL.ImageFile
+import scipy.sparse
 
 import math
 import os
 import typing
 
-# Name that hopefully doesn't belong to another node
-CENTER_NODE = "***CENTER_NODE***"
+# Point every user is pulled towards; it repels users like a node would
+CENTER = (0.0, 0.0)
 
 TEMP_LEGEND_FILENAME = "legend_temp.png"
 
+# Seed of the initial (random) node positions, and of the order nodes are collapsed in by multilevel layouts
+LAYOUT_SEED = 727
+
+# Fraction of users that need a saved position for a layout to start from the last run's rather than from scratch
+WARM_START_MIN_SAVED_FRACTION = 0.5
+
 #################################################################################################################################################
 #################################################################################################################################################
 
-def normalized_node_size(mentions_graph: classes.DirectedGraph, node: str) -> float:
+def normalized_node_sizes(frozen_graph: classes.FrozenGraph) -> numpy.ndarray:
     """
-    Return normalized node size (from 0 to 1).
+    Return normalized node size (from 0 to 1) of each node, indexed by node ID; its in-degree over the largest one.
     """
-    return mentions_graph.in_degrees[node] / max(mentions_graph.in_degrees.values())
+    max_in_degree = int(frozen_graph.in_degrees.max(initial=0))
+    if max_in_degree == 0:
+        return numpy.zeros(frozen_graph.num_vertices)
+    return frozen_graph.in_degrees / max_in_degree
 
 
-def create_base_graph(mentions_graph: classes.DirectedGraph) -> networkx.MultiDiGraph:
+def create_base_graph(frozen_graph: classes.FrozenGraph) -> networkx.MultiDiGraph:
     """
     Add "real" edges and nodes, i.e. those which will be drawn.
     """
     print("Creating base graph...")
 
     G = networkx.MultiDiGraph()
+    G.add_nodes_from(frozen_graph.usernames)
 
-    edges = []
-    for user, users_referred_to in mentions_graph.adj.items():
-        G.add_node(user)
-        for user_referred_to in users_referred_to:
-            n = normalized_node_size(mentions_graph, user_referred_to)
-            edges.append((user, user_referred_to, {"weight": 10.0 * (1.0 - (n**4)), "is_real": True}))
-
-    G.add_edges_from(edges)
+    usernames = frozen_graph.usernames
+    (sources, targets) = frozen_graph.get_edges()
+    G.add_edges_from((usernames[source], usernames[target]) for source, target in zip(sources.tolist(), targets.tolist()))
     return G
 
 
-def add_rank_range_edges(
-        G: networkx.MultiDiGraph,
-        username_to_rank: dict,
+def create_mention_weights(frozen_graph: classes.FrozenGraph, node_sizes: numpy.ndarray) -> scipy.sparse.csr_array:
+    """
+    Weighted adjacency matrix of mentions, for the layout; mentions of bigger nodes pull less.
+    """
+    weights = 10.0 * (1.0 - node_sizes**4)
+    A = frozen_graph.to_scipy()
+    return scipy.sparse.csr_array((weights[A.indices], A.indices, A.indptr), shape=A.shape)
+
+
+def create_rank_range_chains(
+        ranks: numpy.ndarray,
         rank_range_size: int,
-        rank_range_connection_strength: float,
-        rank_range_clustering_weight: float
-    ) -> None:
+        rank_range_connection_strength: float
+    ) -> tuple[numpy.ndarray, numpy.ndarray]:
     """
-    Add weighted invisible edges between nodes in the same rank range.
+    Chain up nodes in the same rank range. Returns the nodes grouped by rank range (in node order within each range),
+    and how many of the nodes after it in its range each node is linked to.
     """
     print(f"Grouping up nodes by rank range...")
 
-    nodes_by_range = {}
-    for node in G.nodes():
-        rank = username_to_rank[node]
-        rank_range = (rank - 1) // rank_range_size
-        if rank_range not in nodes_by_range:
-            nodes_by_range[rank_range] = []
-        nodes_by_range[rank_range].append(node)
-
-    virtual_edges = []
-    for nodes in nodes_by_range.values():
-        for i, node1 in enumerate(nodes):
-            # This is the juicer - We only connect node i to (up to) the next x nodes ahead of it in the list.
-            # This creates a sort of "swirly" effect on the graph where nodes in the same rank range are connected
-            # to eachother in chains rather than a big clump.
-            connection_strength = math.floor(len(nodes) * rank_range_connection_strength)
-            for j in range(i + 1, min(i + connection_strength + 1, len(nodes))):
-                node2 = nodes[j]
-                virtual_edges.append((node1, node2, {"weight": rank_range_clustering_weight, "is_real": False}))
-
-    G.add_edges_from(virtual_edges)
-
-
-def add_center_edges(
-        G: networkx.MultiDiGraph,
-        mentions_graph: classes.DirectedGraph,
-        big_nodes_closer: bool,
-        centrality_weight_factor: float
-    ) -> None:
+    rank_ranges = (ranks - 1) // rank_range_size
+    order = numpy.argsort(rank_ranges, kind="stable")
+
+    range_sizes = numpy.bincount(rank_ranges)
+    range_starts = numpy.cumsum(range_sizes) - range_sizes
+    positions_in_range = numpy.arange(len(order)) - range_starts[rank_ranges[order]]
+
+    # This is the juicer - We only connect node i to (up to) the next x nodes ahead of it in the list.
+    # This creates a sort of "swirly" effect on the graph where nodes in the same rank range are connected
+    # to eachother in chains rather than a big clump.
+    connection_strengths = numpy.floor(range_sizes * rank_range_connection_strength).astype(numpy.int64)
+    reach = numpy.minimum(connection_strengths[rank_ranges[order]], range_sizes[rank_ranges[order]] - 1 - positions_in_range)
+    return order, reach
+
+
+def create_center_weights(node_sizes: numpy.ndarray, centrality_weight_factor: float) -> numpy.ndarray:
     """
-    Create a "center" node and create weighted invisible edges between it and every other node.
+    How strongly each node is pulled towards the center; smaller nodes are pulled in harder.
     """
     print("Grouping up nodes around the center...")
 
-    G.add_node(CENTER_NODE)
+    return centrality_weight_factor * (1.0 - (node_sizes**4))
+
+
+def calculate_layout(
+        frozen_graph: classes.FrozenGraph,
+        A: scipy.sparse.csr_array,
+        virtual_forces: layout.VirtualForces,
+        spring_force: float,
+        iterations: int,
+        multilevel_layout: bool,
+        fresh_layout: bool,
+        layout_params: dict,
+        layout_cache_filename: str
+    ) -> dict:
+    """
+    Position nodes by force-directed placement; mentions (weighted adjacency matrix A) pull nodes together, and
+    virtual_forces pull them towards the center and along rank range chains.
+    If most users were laid out by the last run (with the same layout_params), start from their saved positions, place
+    new users near the users they mention or are mentioned by, and only refine; unless fresh_layout is set.
+    Otherwise, if multilevel_layout is set, a coarsened version of the graph is laid out first and then refined.
+    Final positions are saved to layout_cache_filename for the next run.
+    """
+    print("Calculating node positions...")
 
-    virtual_edges = []
-    for node in G.nodes():
-        if node != CENTER_NODE:
-            n = normalized_node_size(mentions_graph, node)
-            flip = -1.0 if big_nodes_closer else 1.0
-            centrality_weight = flip * centrality_weight_factor * (1.0 - (n**4))
-            virtual_edges.append((node, CENTER_NODE, {"weight": centrality_weight, "is_real": False}))
+    usernames = frozen_graph.usernames
+    pos = numpy.random.RandomState(LAYOUT_SEED).rand(len(usernames), 2)
+
+    cache = layout_cache.LayoutCache(layout_cache_filename)
+    saved_positions = {} if fresh_layout else cache.load_positions(layout_params)
+    is_saved = numpy.array([username in saved_positions for username in usernames], dtype=bool)
+
+    if is_saved.sum() >= WARM_START_MIN_SAVED_FRACTION * len(usernames):
+        print(f"Starting from the last run's positions of {is_saved.sum()} of {len(usernames)} users...")
+        pos[is_saved] = [saved_positions[username] for username in usernames if username in saved_positions]
+        # Unweighted, as edges into the most mentioned users have zero weight in A but should still place new users
+        pos = layout.place_new_nodes(frozen_graph.to_scipy(), pos, is_saved, spring_force, LAYOUT_SEED)
+        pos = layout.refine_layout(A, pos, virtual_forces, spring_force, iterations)
+    elif multilevel_layout:
+        pos = layout.multilevel_layout(A, pos, virtual_forces, spring_force, iterations, LAYOUT_SEED)
+    else:
+        pos = layout.spring_layout(A, pos, virtual_forces, spring_force, iterations)
 
-    G.add_edges_from(virtual_edges)
+    positions = dict(zip(usernames, pos))
+    cache.save_positions(layout_params, positions)
+    cache.close()
+    return positions
 
 
-def rank_to_color(rank: int, num_users: int, rank_range_size: int) -> tuple[int, int, int]:
+def ranks_to_colors(ranks: numpy.ndarray, num_users: int, rank_range_size: int) -> numpy.ndarray:
     """
-    Map rank to RGB color according to gradient scheme.
+    Map each rank to an RGB color according to gradient scheme.
     Colors are distributed evenly across the full gradient based on total number of users.
     Ranks within specified range_size will share the same color.
     """
     num_color_groups = (num_users + rank_range_size - 1) // rank_range_size
     color_step = max(1, 100 // num_color_groups)
-    color_group = (rank - 1) // rank_range_size
-    color_index = (color_group * color_step) % 100
-
-    # (180,60,60) -> (180,150,60)
-    if color_index < 25:
-        return (180, 60 + color_index * 3.6, 60)
-    # (180,150,60) -> (60,180,60)
-    elif color_index < 50:
-        return (180 - (color_index - 25) * 4.8, 150 + (color_index - 25) * 1.2, 60)
-    # (60,180,60) -> (60,180,180)
-    elif color_index < 75:
-        return (60, 180, 60 + (color_index - 50) * 4.8)
-    # (60,180,180) -> (60,60,180)
-    else:
-        return (60, 180 - (color_index - 75) * 4.8, 180)
+    color_groups = (numpy.asarray(ranks) - 1) // rank_range_size
+    color_indices = ((color_groups * color_step) % 100).astype(numpy.float64)
 
+    # (180,60,60) -> (180,150,60) -> (60,180,60) -> (60,180,180) -> (60,60,180)
+    quarters = [color_indices < 25, color_indices < 50, color_indices < 75]
+    red = numpy.select(quarters, [180.0, 180 - (color_indices - 25) * 4.8, 60.0], 60.0)
+    green = numpy.select(quarters, [60 + color_indices * 3.6, 150 + (color_indices - 25) * 1.2, 180.0], 180 - (color_indices - 75) * 4.8)
+    blue = numpy.select(quarters, [60.0, 60.0, 60 + (color_indices - 50) * 4.8], 180.0)
+    return numpy.column_stack((red, green, blue))
 
-def calculate_node_properties(
-        G: networkx.MultiDiGraph,
-        username_to_mentions: dict,
-        username_to_rank: dict,
+
+def calculate_drawing_properties(
+        frozen_graph: classes.FrozenGraph,
+        ranks: numpy.ndarray,
+        node_sizes: numpy.ndarray,
         num_users: int,
         rank_range_size: int,
         min_diameter: int,
         max_diameter: int,
         min_label_size: int,
         max_label_size: int
-    ) -> tuple[list[tuple[float, float, float]], list[float], dict]:
+    ) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
     """
-    Calculate colors, sizes, and label properties for nodes.
+    Calculate colors, areas and label sizes of nodes, and colors of edges (in frozen_graph.get_edges order).
     """
     print("Calculating node properties...")
 
-    # Initialize containers
-    node_colors = []
-    node_sizes = []
-    node_labels = {}
-    nodes = list(G.nodes())
-
-    # Calculate diameter scale factor to map from [0, max_mentions] to [min_diameter, max_diameter]
-    max_mentions = max(username_to_mentions.values())
-    diameter_scale_factor = (max_diameter - min_diameter) / max_mentions if max_mentions > 0 else 0
+    # Calculate color based on rank
+    rgb_colors = ranks_to_colors(ranks, num_users, rank_range_size)
+    node_colors = rgb_colors / 255
 
-    for node in nodes:
-        # Make center node invisible
-        if node == CENTER_NODE:
-            node_colors.append((0.0, 0.0, 0.0))
-            node_sizes.append(0.0)
-            node_labels[node] = 0.0
+    # Calculate diameter based on mentions (linear scaling from min_diameter to max_diameter)
+    diameters = min_diameter + (node_sizes * (max_diameter - min_diameter))
 
-        else:
-            # Calculate color based on rank
-            rank = username_to_rank[node]
-            rgb_color = rank_to_color(rank, num_users, rank_range_size)
-            node_colors.append([x/255 for x in rgb_color])
+    # Convert diameter to area for NetworkX
+    node_areas = math.pi * ((diameters / 2) ** 2)
 
-            # Calculate diameter based on mentions (linear scaling)
-            mention_count = username_to_mentions[node]
-            diameter = min_diameter + (mention_count * diameter_scale_factor)
+    # Calculate label size
+    label_sizes = min_label_size + (node_sizes * max_label_size)
 
-            # Convert diameter to area for NetworkX
-            node_size = math.pi * ((diameter / 2) ** 2)
-            node_sizes.append(node_size)
+    # If A mentions B, give the edge B's color
+    (_, targets) = frozen_graph.get_edges()
+    edge_colors = rgb_colors[targets] / 250
 
-            # Calculate label size
-            diameter_ratio = (diameter - min_diameter) / (max_diameter - min_diameter)
-            label_size = min_label_size + (diameter_ratio * max_label_size)
-            node_labels[node] = label_size
-
-    return node_colors, node_sizes, node_labels
+    return node_colors, node_areas, label_sizes, edge_colors
 
 
 def draw_real_edges(
         G: networkx.MultiDiGraph,
         pos: typing.Mapping,
-        username_to_rank: dict,
-        node_sizes: list[float],
-        num_users: int,
-        rank_range_size: int,
+        frozen_graph: classes.FrozenGraph,
+        edge_colors: numpy.ndarray,
+        node_areas: numpy.ndarray,
         edge_width: int,
         edge_curvature: float,
         arrow_size: int,
         ax: matplotlib.axes.Axes
     ) -> None:
     """
-    Draw non-virtual edges.
+    Draw mention edges.
     """
     print("Drawing edges...")
-    real_edges = []
-    real_edge_colors = []
-    for edge_data in G.edges.data():
-        if edge_data[2]["is_real"] and edge_data[0] != CENTER_NODE and edge_data[1] != CENTER_NODE:
-            real_edges.append((edge_data[0], edge_data[1]))
-
-            # If A mentions B, give the edge B's color
-            mentioned_user_rank = username_to_rank[edge_data[1]]
-            edge_color = rank_to_color(mentioned_user_rank, num_users, rank_range_size)
-            real_edge_colors.append(tuple(x / 250 for x in edge_color))
+    usernames = frozen_graph.usernames
+    (sources, targets) = frozen_graph.get_edges()
+    real_edges = [(usernames[source], usernames[target]) for source, target in zip(sources.tolist(), targets.tolist())]
 
     networkx.draw_networkx_edges(
         G,
         pos,
         edgelist=real_edges,
-        edge_color=real_edge_colors,
+        edge_color=edge_colors,
         alpha=0.35,
         width=edge_width,
-        node_size=node_sizes,
+        node_size=node_areas,
         connectionstyle=f"arc3, rad={edge_curvature}",
         arrowsize=arrow_size,
         ax=ax
@@ -228,18 +235,18 @@ def draw_real_edges(
 def draw_real_nodes(
         G: networkx.MultiDiGraph,
         pos: typing.Mapping,
-        node_sizes: list[float],
-        node_colors: list[tuple[float, float, float]],
+        node_areas: numpy.ndarray,
+        node_colors: numpy.ndarray,
         ax: matplotlib.axes.Axes
     ) -> None:
     """
-    Draw non-virtual nodes.
+    Draw user nodes.
     """
     print("Drawing nodes...")
     networkx.draw_networkx_nodes(
         G,
         pos,
-        node_size=node_sizes,
+        node_size=node_areas,
         node_color=node_colors,
         alpha=0.75,
         edgecolors="black",
@@ -251,24 +258,23 @@ def draw_real_nodes(
 def draw_node_labels(
         G: networkx.MultiDiGraph,
         pos: typing.Mapping,
-        node_labels: dict,
+        frozen_graph: classes.FrozenGraph,
+        label_sizes: numpy.ndarray,
         ax: matplotlib.axes.Axes
     ) -> None:
     """
-    Draw node labels.
+    Draw node labels; NetworkX takes one font size per call, so nodes are drawn in groups of equal label size.
     """
     print("Drawing labels...")
-    labels_by_size = {}
-    for node, size in node_labels.items():
-        if size not in labels_by_size:
-            labels_by_size[size] = {}
-        labels_by_size[size][node] = node
+    usernames = frozen_graph.usernames
+    (font_sizes, size_ids) = numpy.unique(label_sizes, return_inverse=True)
+    nodes_by_size = numpy.split(numpy.argsort(size_ids, kind="stable"), numpy.cumsum(numpy.bincount(size_ids, minlength=len(font_sizes)))[:-1])
 
-    for font_size, node_dict in labels_by_size.items():
+    for font_size, nodes in zip(font_sizes.tolist(), nodes_by_size):
         networkx.draw_networkx_labels(
             G,
             pos,
-            {node: label for node, label in node_dict.items()},
+            {usernames[node]: usernames[node] for node in nodes.tolist()},
             font_size=font_size,
             font_weight="bold",
             font_color="white",
@@ -286,14 +292,14 @@ def create_legend(figsize: tuple[int, int], num_users: int, rank_range_size: int
     # Build legend entries
     legend_elements = []
     num_groups = (num_users + rank_range_size - 1) // rank_range_size
-    for i in range(num_groups):
-        start_rank = i * rank_range_size + 1
-        end_rank = (i + 1) * rank_range_size
-        color = rank_to_color(start_rank, num_users, rank_range_size)
+    start_ranks = numpy.arange(num_groups) * rank_range_size + 1
+    colors = ranks_to_colors(start_ranks, num_users, rank_range_size) / 255
+    for start_rank, color in zip(start_ranks.tolist(), colors.tolist()):
+        end_rank = start_rank + rank_range_size - 1
 
         legend_elements.append(
             matplotlib.patches.Patch(
-                facecolor=[x/255 for x in color],
+                facecolor=color,
                 edgecolor="white",
                 label=f"Rank {start_rank} - {end_rank}",
                 linewidth=0.5
@@ -341,13 +347,14 @@ def paste_onto(background_filename: str, foreground_filename: str) -> PIL.ImageF
 #################################################################################################################################################
 
 def generate_graph(
-        mentions_graph: classes.DirectedGraph,
+        frozen_graph: classes.FrozenGraph,
         username_to_rank: dict,
         spring_force: float,
         iterations: int,
+        multilevel_layout: bool,
+        fresh_layout: bool,
         image_width: int,
         dpi: int,
-        big_nodes_closer: bool,
         centrality_weight_factor: float,
         min_node_diameter: int,
         max_node_diameter: int,
@@ -362,7 +369,8 @@ def generate_graph(
         legend_font_size: int,
         no_graph: bool,
         no_legend: bool,
-        image_filename: str
+        image_filename: str,
+        layout_cache_filename: str
     ) -> None:
     """
     Generate and save graph image.
@@ -373,26 +381,30 @@ def generate_graph(
         print(f"'No graph' flag was set - exiting early...")
         return
 
-    if len(username_to_rank) != len(mentions_graph.adj):
-        raise AssertionError(f"{len(username_to_rank)} != {len(mentions_graph.adj)}")
+    if len(username_to_rank) != frozen_graph.num_vertices:
+        raise AssertionError(f"{len(username_to_rank)} != {frozen_graph.num_vertices}")
     num_users = len(username_to_rank)
 
-    # Add nodes and edges
-    G = create_base_graph(mentions_graph)
-    add_rank_range_edges(G, username_to_rank, rank_range_size, rank_range_connection_strength, rank_range_clustering_weight)
-    add_center_edges(G, mentions_graph, big_nodes_closer, centrality_weight_factor)
+    # Look up what nodes are styled and pulled by once, in node ID order
+    ranks = numpy.array([username_to_rank[username] for username in frozen_graph.usernames])
+    node_sizes = normalized_node_sizes(frozen_graph)
+
+    # Add nodes and edges; rank ranges and the center only shape the layout, so they are forces rather than edges
+    G = create_base_graph(frozen_graph)
+    A = create_mention_weights(frozen_graph, node_sizes)
+    (chain_order, chain_reach) = create_rank_range_chains(ranks, rank_range_size, rank_range_connection_strength)
+    center_weights = create_center_weights(node_sizes, centrality_weight_factor)
+    virtual_forces = layout.VirtualForces(CENTER, center_weights, chain_order, chain_reach, rank_range_clustering_weight)
 
     # Calculate layout
-    print("Calculating node positions...")
-    pos = networkx.spring_layout(
-        G,
-        pos={CENTER_NODE: (0, 0)},
-        fixed=[CENTER_NODE],
-        k=spring_force,
-        iterations=iterations,
-        weight="weight",
-        seed=727
-    )
+    layout_params = {
+        "spring_force": spring_force,
+        "centrality_weight_factor": centrality_weight_factor,
+        "rank_range_size": rank_range_size,
+        "rank_range_connection_strength": rank_range_connection_strength,
+        "rank_range_clustering_weight": rank_range_clustering_weight
+    }
+    pos = calculate_layout(frozen_graph, A, virtual_forces, spring_force, iterations, multilevel_layout, fresh_layout, layout_params, layout_cache_filename)
 
     # Set up figure
     figure_size = (image_width, image_width)
@@ -401,10 +413,10 @@ def generate_graph(
     ax.set_facecolor("black")
 
     # Calculate values for drawing
-    node_colors, node_sizes, node_labels = calculate_node_properties(
-        G,
-        mentions_graph.in_degrees,
-        username_to_rank,
+    node_colors, node_areas, label_sizes, edge_colors = calculate_drawing_properties(
+        frozen_graph,
+        ranks,
+        node_sizes,
         num_users,
         rank_range_size,
         min_node_diameter,
@@ -414,9 +426,9 @@ def generate_graph(
     )
 
     # Draw everything onto the figure
-    draw_real_edges(G, pos, username_to_rank, node_sizes, num_users, rank_range_size, edge_width, edge_curvature, arrow_size, ax)
-    draw_real_nodes(G, pos, node_sizes, node_colors, ax)
-    draw_node_labels(G, pos, node_labels, ax)
+    draw_real_edges(G, pos, frozen_graph, edge_colors, node_areas, edge_width, edge_curvature, arrow_size, ax)
+    draw_real_nodes(G, pos, node_areas, node_colors, ax)
+    draw_node_labels(G, pos, frozen_graph, label_sizes, ax)
 
     # Save graph
     ax.axis("off")
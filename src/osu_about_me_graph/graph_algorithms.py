@@ -0,0 +1,110 @@
+import networkx
+import numpy
+import scipy.sparse
+import scipy.sparse.csgraph
+
+import typing
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def pagerank(
+        A: scipy.sparse.csr_array,
+        alpha: float = 0.85,
+        max_iter: int = 100,
+        tol: float = 1.0e-6,
+        nstart: typing.Union[numpy.ndarray, None] = None
+    ) -> tuple[numpy.ndarray, int]:
+    """
+    PageRank of every node of adjacency matrix A (A[i, j] != 0 iff i links to j), by power iteration.
+    Same algorithm, convergence criterion and defaults as networkx.pagerank (unweighted, no personalization); the rank
+    of dangling nodes (no out links) is spread evenly over all nodes.
+    Starts from nstart (normalized to sum to 1) if given, otherwise uniformly. Returns the ranks and iterations taken.
+    """
+    num_nodes = A.shape[0]
+    if num_nodes == 0:
+        return numpy.zeros(0), 0
+
+    out_degrees = numpy.asarray(A.sum(axis=1)).ravel()
+    is_dangling = out_degrees == 0
+    inverse_out_degrees = numpy.zeros(num_nodes)
+    inverse_out_degrees[~is_dangling] = 1.0 / out_degrees[~is_dangling]
+
+    AT = A.T.tocsr()
+    p = numpy.repeat(1.0 / num_nodes, num_nodes)
+    x = p if nstart is None or nstart.sum() <= 0 else nstart / nstart.sum()
+
+    for i in range(max_iter):
+        x_last = x
+        x = alpha * (AT @ (x_last * inverse_out_degrees) + x_last[is_dangling].sum() * p) + (1 - alpha) * p
+
+        if numpy.absolute(x - x_last).sum() < num_nodes * tol:
+            return x, i + 1
+
+    raise networkx.PowerIterationFailedConvergence(max_iter)
+
+
+def hits(
+        A: scipy.sparse.csr_array,
+        max_iter: int = 1000,
+        tol: float = 1.0e-8,
+        nstart: typing.Union[numpy.ndarray, None] = None
+    ) -> tuple[numpy.ndarray, numpy.ndarray, int]:
+    """
+    HITS hub and authority scores of every node of adjacency matrix A, by power iteration (as in networkx's reference
+    implementation), normalized to sum to 1. Converges to the same vectors networkx.hits computes with an SVD.
+    Starts from hub scores nstart if given, otherwise uniformly. Returns hubs, authorities and iterations taken.
+    """
+    num_nodes = A.shape[0]
+    if num_nodes == 0:
+        return numpy.zeros(0), numpy.zeros(0), 0
+
+    if A.nnz == 0:
+        uniform = numpy.repeat(1.0 / num_nodes, num_nodes)
+        return uniform, uniform.copy(), 0
+
+    AT = A.T.tocsr()
+    if nstart is None or nstart.max() <= 0:
+        h = numpy.repeat(1.0 / num_nodes, num_nodes)
+    else:
+        h = nstart / nstart.max()
+
+    for i in range(max_iter):
+        h_last = h
+        a = AT @ h_last
+        a /= a.max()
+        h = A @ a
+        h /= h.max()
+
+        if numpy.absolute(h - h_last).sum() < tol:
+            return h / h.sum(), a / a.sum(), i + 1
+
+    raise networkx.PowerIterationFailedConvergence(max_iter)
+
+
+def strongly_connected_components(A: scipy.sparse.csr_array) -> list[numpy.ndarray]:
+    """
+    Return the nodes of each strongly connected component of adjacency matrix A.
+    """
+    (num_components, labels) = scipy.sparse.csgraph.connected_components(A, directed=True, connection="strong")
+    nodes_by_label = numpy.argsort(labels, kind="stable")
+    boundaries = numpy.cumsum(numpy.bincount(labels, minlength=num_components))[:-1]
+    return numpy.split(nodes_by_label, boundaries)
+
+
+def reciprocity(A: scipy.sparse.csr_array) -> float:
+    """
+    Fraction of links (ignoring self-links) that are reciprocated, i.e. i -> j where j -> i also exists.
+    Same as networkx.reciprocity for a whole graph without self-links.
+    """
+    A = A.astype(bool)
+    num_self_links = int(A.diagonal().sum())
+    num_links = A.nnz - num_self_links
+    if num_links == 0:
+        raise ValueError("Reciprocity is not defined for graphs without links!")
+
+    num_reciprocated = A.multiply(A.T).nnz - num_self_links
+    return num_reciprocated / num_links
+
+#################################################################################################################################################
+#################################################################################################################################################
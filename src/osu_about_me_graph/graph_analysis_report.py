@@ -1,90 +1,386 @@
+from . import analysis_cache
 from . import classes
+from . import graph_algorithms
 
 import networkx
+import numpy
+
+import collections
+import concurrent.futures
+import csv
+import math
+import random
+import time
+import typing
+
+# Seed used to pick source pivots when approximating betweenness centrality
+BETWEENNESS_SEED = 727
+
+PAGERANK_ALPHA = 0.6
+LOUVAIN_RESOLUTION = 10
+
+# Graph of the current worker process; set once per worker by init_analysis_worker rather than sent with every task
+WORKER_GRAPH = None
+
+# (frozen graph, networkx graph built from it) for the analyses that still run on networkx; built on first use
+NX_GRAPH = None
 
 #################################################################################################################################################
 #################################################################################################################################################
 
-def create_nx_graph(mentions_graph: classes.DirectedGraph) -> networkx.MultiDiGraph:
+def create_nx_graph(frozen_graph: classes.FrozenGraph) -> networkx.MultiDiGraph:
     print("Creating base graph...")
 
     G = networkx.MultiDiGraph()
+    G.add_nodes_from(frozen_graph.usernames)
 
-    edges = []
-    for user, users_referred_to in mentions_graph.adj.items():
-        G.add_node(user)
-        for user_referred_to in users_referred_to:
-            edges.append((user, user_referred_to))
-    
-    G.add_edges_from(edges)
+    (sources, targets) = frozen_graph.get_edges()
+    usernames = frozen_graph.usernames
+    G.add_edges_from((usernames[source], usernames[target]) for source, target in zip(sources.tolist(), targets.tolist()))
     return G
 
+
+def get_nx_graph(frozen_graph: classes.FrozenGraph) -> networkx.MultiDiGraph:
+    """
+    Return the networkx graph of frozen_graph, building it only once per process.
+    """
+    global NX_GRAPH
+    if NX_GRAPH is None or NX_GRAPH[0] is not frozen_graph:
+        NX_GRAPH = (frozen_graph, create_nx_graph(frozen_graph))
+    return NX_GRAPH[1]
+
+
+def run_pagerank(frozen_graph: classes.FrozenGraph, nstart: typing.Union[numpy.ndarray, None]) -> tuple[list[tuple[str, float]], int]:
+    (pagerank, iterations) = graph_algorithms.pagerank(frozen_graph.to_scipy(), alpha=PAGERANK_ALPHA, nstart=nstart)
+    return sorted(zip(frozen_graph.usernames, pagerank.tolist()), key=lambda user: user[1], reverse=True), iterations
+
+
+def run_betweenness_part(frozen_graph: classes.FrozenGraph, pivots: list[str]) -> dict[str, float]:
+    """
+    Sum the (unnormalized) shortest path dependencies of every node on the given source pivots.
+    Summing the parts of disjoint sets of pivots gives the same as computing all of them at once.
+    """
+    G = get_nx_graph(frozen_graph)
+    return networkx.betweenness_centrality_subset(G, pivots, list(G), normalized=False)
+
+
+def merge_betweenness_parts(parts: list[dict[str, float]], usernames: list[str], pivots: list[str]) -> list[tuple[str, float]]:
+    """
+    Add up betweenness parts and normalize them by the number of ordered pairs of other nodes, (n - 1)(n - 2), as is
+    usual for directed graphs.
+    If only k < n nodes were used as pivots, each node's sum is first extrapolated to all n - 1 sources that could have a
+    shortest path through it (a node is never on a path from itself): the k pivots are a uniform sample, so a node
+    that is one of them got k - 1 of those sources, and any other node got k. This is an unbiased estimate of the exact
+    value, and doesn't rely on how any networkx version scales its own sampled betweenness.
+    """
+    # fsum, so that the result doesn't depend on the order parts finished in
+    betweenness_centrality = {username: math.fsum(part[username] for part in parts) for username in usernames}
+
+    num_pairs = len(usernames) - 1
+    num_pivots = len(pivots)
+    if num_pairs >= 2:
+        if num_pivots == len(usernames):
+            scale = 1 / (num_pairs * (num_pairs - 1))
+            for username in betweenness_centrality:
+                betweenness_centrality[username] *= scale
+        else:
+            pivot_set = set(pivots)
+            # (n - 1) / (k - 1) or (n - 1) / k, times 1 / ((n - 1)(n - 2))
+            pivot_scale = 1 / ((num_pivots - 1) * (num_pairs - 1))
+            other_scale = 1 / (num_pivots * (num_pairs - 1))
+            for username in betweenness_centrality:
+                betweenness_centrality[username] *= pivot_scale if username in pivot_set else other_scale
+
+    return sorted(betweenness_centrality.items(), key=lambda user: user[1], reverse=True)
+
+
+def run_hits(
+        frozen_graph: classes.FrozenGraph,
+        nstart: typing.Union[numpy.ndarray, None]
+    ) -> tuple[list[tuple[str, float]], list[tuple[str, float]], int]:
+    (hits_hubs, hits_authorities, iterations) = graph_algorithms.hits(frozen_graph.to_scipy(), nstart=nstart)
+    hits_hubs = sorted(zip(frozen_graph.usernames, hits_hubs.tolist()), key=lambda user: user[1], reverse=True)
+    hits_authorities = sorted(zip(frozen_graph.usernames, hits_authorities.tolist()), key=lambda user: user[1], reverse=True)
+    return hits_hubs, hits_authorities, iterations
+
+
+def run_louvain_communities(frozen_graph: classes.FrozenGraph) -> list[set[str]]:
+    louvain_communities = networkx.community.louvain_communities(get_nx_graph(frozen_graph), resolution=LOUVAIN_RESOLUTION)
+    louvain_communities = sorted(louvain_communities, key=lambda community: len(community), reverse=True)
+    return [community for community in louvain_communities if len(community) > 1]
+
+
+def run_strongly_connected_components(frozen_graph: classes.FrozenGraph) -> list[set[str]]:
+    strongly_connected_components = [
+        {frozen_graph.usernames[i] for i in component.tolist()}
+        for component in graph_algorithms.strongly_connected_components(frozen_graph.to_scipy())
+    ]
+    strongly_connected_components = sorted(strongly_connected_components, key=lambda component: len(component), reverse=True)
+    return [component for component in strongly_connected_components if len(component) > 1]
+
+
+def run_reciprocity(frozen_graph: classes.FrozenGraph) -> float:
+    return graph_algorithms.reciprocity(frozen_graph.to_scipy())
+
+
+# Analyses that run as a single task each, roughly slowest first so that slow ones start as early as possible.
+# Betweenness centrality (the slowest) is split into one task per worker instead, see run_analyses.
+ANALYSES = {
+    "Communities (Louvain)": run_louvain_communities,
+    "HITS": run_hits,
+    "PageRank": run_pagerank,
+    "Strongly Connected Components": run_strongly_connected_components,
+    "Reciprocity": run_reciprocity,
+}
+
+BETWEENNESS_CENTRALITY = "Betweenness Centrality"
+
+
+def select_betweenness_pivots(usernames: list[str], betweenness_samples: typing.Union[int, None]) -> list[str]:
+    """
+    Return the source pivots to compute betweenness centrality from; every node, or betweenness_samples of them picked
+    with a fixed seed.
+    """
+    if betweenness_samples is None or betweenness_samples >= len(usernames):
+        return list(usernames)
+    return random.Random(BETWEENNESS_SEED).sample(usernames, betweenness_samples)
+
+
+def run_analysis(name: str, function: typing.Callable[..., typing.Any], args: tuple, frozen_graph: classes.FrozenGraph) -> tuple[str, typing.Any, float]:
+    """
+    Run an analysis (or part of one) on frozen_graph. Returns its name, result and how long it took (in seconds).
+    """
+    start = time.perf_counter()
+    result = function(frozen_graph, *args)
+    return name, result, time.perf_counter() - start
+
+
+def init_analysis_worker(frozen_graph: classes.FrozenGraph) -> None:
+    global WORKER_GRAPH
+    WORKER_GRAPH = frozen_graph
+
+
+def run_analysis_in_worker(name: str, function: typing.Callable[..., typing.Any], args: tuple) -> tuple[str, typing.Any, float]:
+    return run_analysis(name, function, args, WORKER_GRAPH)
+
+
+def run_analyses(
+        frozen_graph: classes.FrozenGraph,
+        analysis_workers: int,
+        betweenness_pivots: list[str],
+        analysis_args: dict[str, tuple],
+        names: list[str]
+    ) -> dict[str, tuple[typing.Any, float]]:
+    """
+    Run the named analyses, across analysis_workers processes if it is greater than 1. Workers are sent the frozen graph
+    (a few arrays, cheap to pickle) once; PageRank, HITS, SCC and reciprocity run on its sparse adjacency matrix, and
+    workers that run betweenness centrality or Louvain build a networkx graph from it.
+    Betweenness centrality is computed from the given pivots, split evenly between the workers and merged afterwards.
+    Other analyses are passed their extra arguments from analysis_args, if any.
+    Returns a map from analysis name to (result, seconds taken). Time taken by split analyses is summed over the parts.
+    """
+    num_parts = max(1, min(analysis_workers, len(betweenness_pivots))) if BETWEENNESS_CENTRALITY in names else 0
+    tasks = [(BETWEENNESS_CENTRALITY, run_betweenness_part, (betweenness_pivots[i::num_parts],)) for i in range(num_parts)]
+    tasks += [(name, function, analysis_args.get(name, ())) for name, function in ANALYSES.items() if name in names]
+    if not tasks:
+        return {}
+
+    partial_results = collections.defaultdict(list)
+    elapsed_secs = collections.defaultdict(float)
+
+    def collect(name: str, result: typing.Any, elapsed_sec: float) -> None:
+        partial_results[name].append(result)
+        elapsed_secs[name] += elapsed_sec
+        num_done = len(partial_results[name])
+        part = f" (part {num_done}/{num_parts})" if name == BETWEENNESS_CENTRALITY and num_parts > 1 else ""
+        print(f"{name}{part} took {elapsed_sec:.2f} seconds.")
+
+    num_workers = min(analysis_workers, len(tasks))
+    if num_workers <= 1:
+        for name, function, args in tasks:
+            collect(*run_analysis(name, function, args, frozen_graph))
+
+        global NX_GRAPH
+        NX_GRAPH = None
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=init_analysis_worker, initargs=(frozen_graph,)) as executor:
+            futures = [executor.submit(run_analysis_in_worker, name, function, args) for name, function, args in tasks]
+            for future in concurrent.futures.as_completed(futures):
+                collect(*future.result())
+
+    results = {name: (partial_results[name][0], elapsed_secs[name]) for name in ANALYSES if name in names}
+    if BETWEENNESS_CENTRALITY in names:
+        betweenness_centrality = merge_betweenness_parts(partial_results[BETWEENNESS_CENTRALITY], frozen_graph.usernames, betweenness_pivots)
+        results[BETWEENNESS_CENTRALITY] = (betweenness_centrality, elapsed_secs[BETWEENNESS_CENTRALITY])
+    return results
+
+
+def get_analysis_params(betweenness_pivots: list[str]) -> dict[str, dict]:
+    """
+    Return the parameters each analysis' result depends on (besides the graph itself).
+    """
+    return {
+        BETWEENNESS_CENTRALITY: {"pivots": sorted(betweenness_pivots)},
+        "Communities (Louvain)": {"resolution": LOUVAIN_RESOLUTION},
+        "HITS": {"tol": 1.0e-8},
+        "PageRank": {"alpha": PAGERANK_ALPHA, "tol": 1.0e-6},
+        "Strongly Connected Components": {},
+        "Reciprocity": {},
+    }
+
+
+def describe_convergence(cache: analysis_cache.AnalysisCache, algorithm: str, iterations: int, warm_started: bool) -> str:
+    """
+    Describe how many iterations algorithm took; compared to the last uniformly started run if it was warm started.
+    """
+    if not warm_started:
+        cache.set_cold_iterations(algorithm, iterations)
+        return f"\nConverged in {iterations} iterations."
+
+    cold_iterations = cache.get_cold_iterations(algorithm)
+    if cold_iterations is None:
+        return f"\nConverged in {iterations} iterations, starting from the previous run's scores."
+    return f"\nConverged in {iterations} iterations, starting from the previous run's scores ({cold_iterations - iterations} saved compared to a uniform start)."
+
+
+def write_analysis_csv(
+        analysis_csv_filename: str,
+        usernames: list[str],
+        scores: dict[str, list[tuple[str, float]]],
+        groups: dict[str, list[typing.Iterable[str]]]
+    ) -> None:
+    """
+    Write one row per user with each of their scores, and the (1-based, as numbered in the report) group they belong to
+    for each grouping; empty if they are not in any group of more than one user. Scores and groups are first laid out
+    as columns in the graph's user order (rather than each score's ranking), and the rows are zipped from them.
+    """
+    username_to_index = {username: i for i, username in enumerate(usernames)}
+
+    score_columns = []
+    for user_scores in scores.values():
+        column = numpy.zeros(len(usernames))
+        column[[username_to_index[username] for username, _ in user_scores]] = [score for _, score in user_scores]
+        score_columns.append(column.tolist())
+
+    group_columns = []
+    for user_groups in groups.values():
+        column = [""] * len(usernames)
+        for i, group in enumerate(user_groups):
+            for username in group:
+                column[username_to_index[username]] = i + 1
+        group_columns.append(column)
+
+    with open(analysis_csv_filename, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["username"] + list(scores) + list(groups))
+        writer.writerows(zip(usernames, *score_columns, *group_columns))
+
+
+def describe_top_k(num_users: int, report_top_k: typing.Union[int, None]) -> list[str]:
+    """
+    Lines noting that a score list was cut down to its top report_top_k users, if it was.
+    """
+    if report_top_k is None or num_users <= report_top_k:
+        return []
+    return [f"\nTop {report_top_k} of {num_users} users; see the CSV output for all of them."]
+
 #################################################################################################################################################
 #################################################################################################################################################
 
-def graph_analysis_report(mentions_graph: classes.DirectedGraph, analysis_report_filename: str, no_analysis_report: bool) -> None:
+def graph_analysis_report(
+        frozen_graph: classes.FrozenGraph,
+        analysis_report_filename: str,
+        analysis_csv_filename: str,
+        no_analysis_report: bool,
+        analysis_workers: int,
+        betweenness_samples: typing.Union[int, None],
+        analysis_cache_filename: str,
+        report_top_k: typing.Union[int, None]
+    ) -> None:
     """
     Generates a file containing results of graph analysis algorithms; e.g. betweenness centrality, PageRank, etc.
+    The algorithms are independent of each other, so they are run concurrently across analysis_workers processes.
+    If betweenness_samples is set, betweenness centrality is approximated from that many (seeded) random source pivots.
+    PageRank and HITS start from the scores of the previous run (saved in analysis_cache_filename) where possible.
+    Results are also cached by a fingerprint of the graph and each algorithm's parameters; if neither changed since
+    the last run, the report is rebuilt from the cache without running anything.
+    Every user's scores and groups are written to analysis_csv_filename; if report_top_k is set, the report itself only
+    lists the top report_top_k users of each score.
     """
-    print(f"\n--- Generating graph analysis report for {len(mentions_graph.adj)} users...")
+    print(f"\n--- Generating graph analysis report for {frozen_graph.num_vertices} users...")
 
     if no_analysis_report:
         print(f"'No analysis' flag was set - exiting early...")
         return
 
-    # Convert graph
-    G = create_nx_graph(mentions_graph)
-
-    # PageRank
-    pagerank = networkx.pagerank(G, alpha=0.6)
-    pagerank = sorted(pagerank.items(), key=lambda user: user[1], reverse=True)
+    cache = analysis_cache.AnalysisCache(analysis_cache_filename)
+    pagerank_start = cache.load_scores("pagerank", frozen_graph.usernames)
+    hits_start = cache.load_scores("hits_hubs", frozen_graph.usernames)
 
-    # Betweenness centrality
-    betweenness_centrality = networkx.betweenness_centrality(G)
-    betweenness_centrality = sorted(betweenness_centrality.items(), key=lambda user: user[1], reverse=True)
+    betweenness_pivots = select_betweenness_pivots(frozen_graph.usernames, betweenness_samples)
 
-    # HITS
-    (hits_hubs, hits_authorities) = networkx.hits(G)
-    hits_hubs = sorted(hits_hubs.items(), key=lambda user: user[1], reverse=True)
-    hits_authorities = sorted(hits_authorities.items(), key=lambda user: user[1], reverse=True)
-
-    # (Louvain) Communities
-    louvain_communities = networkx.community.louvain_communities(G, resolution=10)
-    louvain_communities = sorted(louvain_communities, key=lambda community: len(community), reverse=True)
-    louvain_communities = [community for community in louvain_communities if len(community) > 1]
+    graph_fingerprint = frozen_graph.fingerprint()
+    result_keys = {name: analysis_cache.make_result_key(graph_fingerprint, params) for name, params in get_analysis_params(betweenness_pivots).items()}
+    results = {}
+    for name, result_key in result_keys.items():
+        cached_result = cache.get_result(name, result_key)
+        if cached_result is not None:
+            results[name] = cached_result
+    cached_names = set(results)
+    if cached_names:
+        print(f"Loaded cached results for: {', '.join(name for name in result_keys if name in cached_names)}")
 
-    # Strongly connected components
-    strongly_connected_components = networkx.strongly_connected_components(G)
-    strongly_connected_components = sorted(list(strongly_connected_components), key=lambda component: len(component), reverse=True)
-    strongly_connected_components = [component for component in strongly_connected_components if len(component) > 1]
+    names_to_run = [name for name in result_keys if name not in cached_names]
+    new_results = run_analyses(frozen_graph, analysis_workers, betweenness_pivots, {"PageRank": (pagerank_start,), "HITS": (hits_start,)}, names_to_run)
+    for name, (result, elapsed_sec) in new_results.items():
+        cache.put_result(name, result_keys[name], result, elapsed_sec)
+    results.update(new_results)
 
-    # Reciprocity
-    reciprocity = networkx.reciprocity(G)
+    ((pagerank, pagerank_iterations), _) = results["PageRank"]
+    (betweenness_centrality, _) = results[BETWEENNESS_CENTRALITY]
+    ((hits_hubs, hits_authorities, hits_iterations), _) = results["HITS"]
+    (louvain_communities, _) = results["Communities (Louvain)"]
+    (strongly_connected_components, _) = results["Strongly Connected Components"]
+    (reciprocity, _) = results["Reciprocity"]
 
     # Build report
     lines = ["### Graph Analysis Report",]
 
     lines.extend(["\n---", "**PageRank**"])
+    if "PageRank" in cached_names:
+        lines.append("\nLoaded from cache (graph unchanged since the last run).")
+    else:
+        lines.append(describe_convergence(cache, "pagerank", pagerank_iterations, pagerank_start is not None))
+    lines.extend(describe_top_k(len(pagerank), report_top_k))
     lines.append("\n```")
-    for user in pagerank:
+    for user in pagerank[:report_top_k]:
         lines.append(f"{user[0]} : {user[1]:.8f}")
     lines.append("```")
 
     lines.extend(["\n---", "**Betweenness Centrality**"])
+    if len(betweenness_pivots) < frozen_graph.num_vertices:
+        lines.append(f"\nApproximated from {len(betweenness_pivots)} of {frozen_graph.num_vertices} users as source pivots (seed {BETWEENNESS_SEED}).")
+    lines.extend(describe_top_k(len(betweenness_centrality), report_top_k))
     lines.append("\n```")
-    for user in betweenness_centrality:
+    for user in betweenness_centrality[:report_top_k]:
         lines.append(f"{user[0]} : {user[1]:.8f}")
     lines.append("```")
 
     lines.extend(["\n---", "**Hubs (HITS)**"])
+    if "HITS" in cached_names:
+        lines.append("\nLoaded from cache (graph unchanged since the last run).")
+    else:
+        lines.append(describe_convergence(cache, "hits_hubs", hits_iterations, hits_start is not None))
+    lines.extend(describe_top_k(len(hits_hubs), report_top_k))
     lines.append("\n```")
-    for user in hits_hubs:
+    for user in hits_hubs[:report_top_k]:
         lines.append(f"{user[0]} : {user[1]:.8f}")
     lines.append("```")
 
     lines.extend(["\n---", "**Authorities (HITS)**"])
+    lines.extend(describe_top_k(len(hits_authorities), report_top_k))
     lines.append("\n```")
-    for user in hits_authorities:
+    for user in hits_authorities[:report_top_k]:
         lines.append(f"{user[0]} : {user[1]:.8f}")
     lines.append("```")
 
@@ -92,7 +388,7 @@ def graph_analysis_report(mentions_graph: classes.DirectedGraph, analysis_report
     lines.append("\n```")
     for i, community in enumerate(louvain_communities):
         lines.append(f"Community {i + 1}:")
-        for username in community:
+        for username in sorted(community):
             lines.append(f"    {username}")
     lines.append("```")
 
@@ -100,7 +396,7 @@ def graph_analysis_report(mentions_graph: classes.DirectedGraph, analysis_report
     lines.append("\n```")
     for i, component in enumerate(strongly_connected_components):
         lines.append(f"Component {i + 1}:")
-        for username in component:
+        for username in sorted(component):
             lines.append(f"    {username}")
     lines.append("```")
 
@@ -109,11 +405,40 @@ def graph_analysis_report(mentions_graph: classes.DirectedGraph, analysis_report
     lines.append(f"{reciprocity}")
     lines.append("```")
 
+    lines.extend(["\n---", "**Timing**"])
+    lines.append("\n```")
+    for name in [BETWEENNESS_CENTRALITY] + list(ANALYSES):
+        (_, elapsed_sec) = results[name]
+        lines.append(f"{name} : {elapsed_sec:.2f}s" + (" (cached)" if name in cached_names else ""))
+    lines.append("```")
+
     lines.append("\n---")
 
     # Print to file
     with open(analysis_report_filename, "w") as f:
         f.writelines(line + "\n" for line in lines)
 
+    write_analysis_csv(
+        analysis_csv_filename,
+        frozen_graph.usernames,
+        {
+            "pagerank": pagerank,
+            "betweenness_centrality": betweenness_centrality,
+            "hits_hub": hits_hubs,
+            "hits_authority": hits_authorities
+        },
+        {
+            "louvain_community": louvain_communities,
+            "strongly_connected_component": strongly_connected_components
+        }
+    )
+
+    # Save scores for the next run to start from
+    if "PageRank" not in cached_names:
+        cache.save_scores("pagerank", pagerank)
+    if "HITS" not in cached_names:
+        cache.save_scores("hits_hubs", hits_hubs)
+    cache.close()
+
 #################################################################################################################################################
 #################################################################################################################################################
@@ -0,0 +1,513 @@
+import numpy
+import scipy.optimize
+import scipy.sparse
+import scipy.sparse.csgraph
+
+import math
+import random
+import typing
+
+# Graphs with at most this many nodes get exact (all pairs) repulsion; larger ones approximate it on a hierarchy of grids
+EXACT_REPULSION_MAX_NODES = 1000
+
+# Nodes per chunk when computing all pairs repulsion, to bound memory use
+REPULSION_CHUNK_SIZE = 500
+
+# Average number of nodes per cell of the finest grid; nodes in neighbouring cells of it repel each other exactly
+NODES_PER_CELL = 4
+
+# Finest grid is refined further (up to MAX_GRID_LEVEL) while it would compare more than this many pairs per node exactly
+MAX_NEAR_PAIRS_PER_NODE = 64
+MAX_GRID_LEVEL = 12
+
+# Distances between nodes are taken to be at least this, as by networkx.spring_layout (method="force")
+MIN_DISTANCE = 0.01
+
+# Graphs are coarsened until they have at most this many nodes, or a level shrinks them by less than COARSEN_MIN_SHRINK
+COARSEST_MAX_NODES = 100
+COARSEN_MIN_SHRINK = 0.1
+
+# Layouts that start out good (finer levels of a multilevel layout, or the last run's) run this many times fewer iterations
+REFINE_ITERATIONS_DIVISOR = 5
+
+# Nodes that start out at the same spot as others (finer levels of a multilevel layout, or new nodes placed among the last
+# run's) are nudged apart by up to this fraction of the spring length
+NUDGE_FACTOR = 0.02
+
+# Offsets of the cells next to a cell (and the cell itself)
+NEAR_OFFSETS = numpy.array([(dx, dy) for dx in range(-1, 2) for dy in range(-1, 2)])
+
+# Offsets of the cells that are not next to a cell, but whose parents are next to its parent; by the cell's (x, y) parity
+FAR_OFFSETS = numpy.array([
+    [
+        (dx, dy)
+        for dx in range(-3, 4) for dy in range(-3, 4)
+        if max(abs(dx), abs(dy)) > 1 and abs((parity_x + dx) // 2) <= 1 and abs((parity_y + dy) // 2) <= 1
+    ]
+    for parity_x in range(2) for parity_y in range(2)
+])
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def exact_repulsion(pos: numpy.ndarray, k: float, masses: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Fruchterman-Reingold repulsion (mass * k^2 / distance, away from every other node) on each node, and the potential
+    energy of each node from it (-mass * k^2 * log(distance), summed over every other node).
+    """
+    displacement = numpy.zeros_like(pos)
+    potential = numpy.zeros(len(pos))
+    for start in range(0, len(pos), REPULSION_CHUNK_SIZE):
+        delta = pos[start:start + REPULSION_CHUNK_SIZE, numpy.newaxis, :] - pos[numpy.newaxis, :, :]
+        distance2 = numpy.maximum((delta**2).sum(axis=2), MIN_DISTANCE**2)
+        displacement[start:start + REPULSION_CHUNK_SIZE] = (delta * (masses * (k * k) / distance2)[:, :, numpy.newaxis]).sum(axis=1)
+        potential[start:start + REPULSION_CHUNK_SIZE] = -(k * k / 2) * (masses * numpy.log(distance2)).sum(axis=1)
+    return displacement, potential
+
+
+def grid_cells(pos: numpy.ndarray, lower: numpy.ndarray, size: float, level: int) -> numpy.ndarray:
+    """
+    (x, y) cell of each node on a grid of 2^level by 2^level cells covering the square at lower with side length size.
+    """
+    num_cells = 2**level
+    return numpy.minimum(((pos - lower) * (num_cells / size)).astype(numpy.int64), num_cells - 1)
+
+
+def far_repulsion(
+        pos: numpy.ndarray,
+        k: float,
+        masses: numpy.ndarray,
+        cells: numpy.ndarray,
+        level: int
+    ) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Repulsion on each node from the cells of the grid at level which are not next to its own cell, but whose parent
+    cells are next to its parent cell. Every such cell acts as a single node of its total mass at its centroid.
+    Summed over all levels, this covers every node that is not in a neighbouring cell of the finest grid.
+    """
+    # Cells are padded by the largest offset on every side, so that cells off the grid read as empty
+    padded_width = 2**level + 6
+    flat_cells = (cells[:, 0] + 3) * padded_width + (cells[:, 1] + 3)
+    mass = numpy.bincount(flat_cells, weights=masses, minlength=padded_width * padded_width)
+    sum_x = numpy.bincount(flat_cells, weights=masses * pos[:, 0], minlength=padded_width * padded_width)
+    sum_y = numpy.bincount(flat_cells, weights=masses * pos[:, 1], minlength=padded_width * padded_width)
+
+    flat_offsets = FAR_OFFSETS[:, :, 0] * padded_width + FAR_OFFSETS[:, :, 1]
+    targets = flat_cells[:, numpy.newaxis] + flat_offsets[(cells[:, 0] % 2) * 2 + cells[:, 1] % 2]
+
+    target_mass = mass[targets]
+    occupied_mass = numpy.where(target_mass > 0, target_mass, 1.0)
+    delta_x = pos[:, 0, numpy.newaxis] - sum_x[targets] / occupied_mass
+    delta_y = pos[:, 1, numpy.newaxis] - sum_y[targets] / occupied_mass
+
+    # Empty cells have no mass, so their (meaningless) delta adds nothing
+    distance2 = numpy.maximum(delta_x**2 + delta_y**2, MIN_DISTANCE**2)
+    force = target_mass * (k * k) / distance2
+    potential = -(k * k / 2) * (target_mass * numpy.log(distance2)).sum(axis=1)
+    return numpy.column_stack(((delta_x * force).sum(axis=1), (delta_y * force).sum(axis=1))), potential
+
+
+def near_repulsion(
+        pos: numpy.ndarray,
+        k: float,
+        masses: numpy.ndarray,
+        cells: numpy.ndarray,
+        level: int
+    ) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Exact repulsion on each node from every node in its own or a neighbouring cell of the grid at level.
+    """
+    num_nodes = len(pos)
+    num_cells = 2**level
+    flat_cells = cells[:, 0] * num_cells + cells[:, 1]
+    order = numpy.argsort(flat_cells, kind="stable")
+    counts = numpy.bincount(flat_cells, minlength=num_cells * num_cells)
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)))
+
+    targets = cells[:, numpy.newaxis, :] + NEAR_OFFSETS[numpy.newaxis, :, :]
+    is_on_grid = ((targets >= 0) & (targets < num_cells)).all(axis=2)
+    flat_targets = numpy.where(is_on_grid, targets[:, :, 0] * num_cells + targets[:, :, 1], 0)
+    target_counts = numpy.where(is_on_grid, counts[flat_targets], 0).ravel()
+
+    # Pair every node with each node of its neighbouring cells
+    pair_starts = numpy.repeat(starts[flat_targets].ravel(), target_counts)
+    pair_offsets = numpy.arange(len(pair_starts)) - numpy.repeat(numpy.cumsum(target_counts) - target_counts, target_counts)
+    pair_i = numpy.repeat(numpy.repeat(numpy.arange(num_nodes), len(NEAR_OFFSETS)), target_counts)
+    pair_j = order[pair_starts + pair_offsets]
+
+    # Pairs of a node with itself have no delta, so they add no force (and a constant potential)
+    delta = pos[pair_i] - pos[pair_j]
+    distance2 = numpy.maximum((delta**2).sum(axis=1), MIN_DISTANCE**2)
+    force = masses[pair_j] * (k * k) / distance2
+    displacement = numpy.column_stack((
+        numpy.bincount(pair_i, weights=delta[:, 0] * force, minlength=num_nodes),
+        numpy.bincount(pair_i, weights=delta[:, 1] * force, minlength=num_nodes)
+    ))
+    return displacement, numpy.bincount(pair_i, weights=-(k * k / 2) * masses[pair_j] * numpy.log(distance2), minlength=num_nodes)
+
+
+def finest_grid_level(pos: numpy.ndarray, lower: numpy.ndarray, size: float) -> int:
+    """
+    Coarsest level whose grid has about NODES_PER_CELL nodes per cell and no more than MAX_NEAR_PAIRS_PER_NODE pairs of
+    nodes in neighbouring cells per node; finer grids make for more far cells, coarser ones for more near pairs.
+    """
+    num_nodes = len(pos)
+    level = max(2, math.ceil(math.log(max(num_nodes / NODES_PER_CELL, 1), 4)))
+    while level < MAX_GRID_LEVEL:
+        num_cells = 2**level
+        cells = grid_cells(pos, lower, size, level)
+        counts = numpy.bincount(cells[:, 0] * num_cells + cells[:, 1], minlength=num_cells * num_cells).reshape(num_cells, num_cells)
+        neighbourhood_counts = numpy.pad(counts, 1)
+        neighbourhood_counts = sum(
+            neighbourhood_counts[1 + dx:1 + dx + num_cells, 1 + dy:1 + dy + num_cells] for dx, dy in NEAR_OFFSETS
+        )
+        if (counts * neighbourhood_counts).sum() <= MAX_NEAR_PAIRS_PER_NODE * num_nodes:
+            break
+        level += 1
+    return level
+
+
+def grid_repulsion(pos: numpy.ndarray, k: float, masses: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Approximate Fruchterman-Reingold repulsion on each node, and potential energy of each node from it (see
+    exact_repulsion): exact from nodes close by, and from the centroids of ever larger grid cells (like a Barnes-Hut
+    quadtree) the further away they are. O(n) per call rather than O(n^2).
+    """
+    lower = pos.min(axis=0)
+    size = max(float((pos.max(axis=0) - lower).max()), MIN_DISTANCE) * (1 + 1e-9)
+    finest_level = finest_grid_level(pos, lower, size)
+
+    (displacement, potential) = near_repulsion(pos, k, masses, grid_cells(pos, lower, size, finest_level), finest_level)
+    for level in range(2, finest_level + 1):
+        (far_displacement, far_potential) = far_repulsion(pos, k, masses, grid_cells(pos, lower, size, level), level)
+        displacement += far_displacement
+        potential += far_potential
+    return displacement, potential
+
+
+def attraction(
+        pos: numpy.ndarray,
+        k: float,
+        sources: numpy.ndarray,
+        targets: numpy.ndarray,
+        weights: numpy.ndarray
+    ) -> tuple[numpy.ndarray, float]:
+    """
+    Fruchterman-Reingold attraction (weight * distance^2 / k) of each edge's source towards its target, and the
+    potential energy of the edges (weight * distance^3 / 3k).
+    """
+    delta = pos[sources] - pos[targets]
+    distance = numpy.maximum(numpy.sqrt((delta**2).sum(axis=1)), MIN_DISTANCE)
+    force = weights * distance / k
+    displacement = -numpy.column_stack((
+        numpy.bincount(sources, weights=delta[:, 0] * force, minlength=len(pos)),
+        numpy.bincount(sources, weights=delta[:, 1] * force, minlength=len(pos))
+    ))
+    return displacement, float((force * distance**2).sum()) / 3
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+class VirtualForces:
+    """
+    Forces that shape the layout without being edges of the graph, so that the graph only has to hold real edges.
+    * center: a point fixed at center, which repels nodes like any other node and pulls each of them in by their center
+      weight (as if by an edge of that weight).
+    * chains: the nodes of chain_order are each pulled towards (up to) the next chain_reach of them, and vice versa,
+      as if by edges of chain_weight.
+    Like edge weights in networkx.spring_layout, weights are taken as absolute values; negative ones pull too.
+    """
+    def __init__(
+            self,
+            center: tuple[float, float],
+            center_weights: numpy.ndarray,
+            chain_order: numpy.ndarray,
+            chain_reach: numpy.ndarray,
+            chain_weight: float
+        ):
+        self.center = numpy.asarray(center, dtype=numpy.float64)
+        self.center_weights = numpy.abs(numpy.asarray(center_weights, dtype=numpy.float64))
+        self.chain_order = numpy.asarray(chain_order, dtype=numpy.int64)
+        self.chain_reach = numpy.asarray(chain_reach, dtype=numpy.int64)
+        self.chain_weight = abs(chain_weight)
+
+    def get_chain_links(self, offset: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        (sources, targets) of the chain links between nodes offset apart in chain_order.
+        """
+        positions = numpy.flatnonzero(self.chain_reach >= offset)
+        return self.chain_order[positions], self.chain_order[positions + offset]
+
+    def iter_chain_links(self) -> typing.Iterator[tuple[numpy.ndarray, numpy.ndarray]]:
+        for offset in range(1, int(self.chain_reach.max(initial=0)) + 1):
+            yield self.get_chain_links(offset)
+
+    def to_chain_matrix(self) -> scipy.sparse.csr_array:
+        """
+        Chain links as a weighted adjacency matrix.
+        """
+        num_nodes = len(self.center_weights)
+        links = list(self.iter_chain_links())
+        sources = numpy.concatenate([sources for sources, _ in links] + [numpy.zeros(0, dtype=numpy.int64)])
+        targets = numpy.concatenate([targets for _, targets in links] + [numpy.zeros(0, dtype=numpy.int64)])
+        weights = numpy.full(len(sources), float(self.chain_weight))
+        return scipy.sparse.csr_array((weights, (sources, targets)), shape=(num_nodes, num_nodes))
+
+    def coarsen(self, clusters: numpy.ndarray) -> "VirtualForces":
+        """
+        Forces on the clusters of a coarsened graph: each is pulled in by the total center weight of its nodes. Chain
+        links between clusters are edges of the coarsened graph (see coarsen), so there are no chains left.
+        """
+        return VirtualForces(self.center, numpy.bincount(clusters, weights=self.center_weights), [], [], self.chain_weight)
+
+    def attraction(self, pos: numpy.ndarray, k: float) -> tuple[numpy.ndarray, float]:
+        """
+        Fruchterman-Reingold attraction of each node towards the center and its chain neighbours, and the potential
+        energy of these pulls. Like edges, a pull is shared by both of its ends; the center doesn't move, so its half of
+        the force is dropped.
+        """
+        delta = pos - self.center
+        distance = numpy.maximum(numpy.sqrt((delta**2).sum(axis=1)), MIN_DISTANCE)
+        force = (self.center_weights / 2) * distance / k
+        displacement = -delta * force[:, numpy.newaxis]
+        energy = 2 * float((force * distance**2).sum()) / 3
+
+        for sources, targets in self.iter_chain_links():
+            weights = numpy.full(2 * len(sources), self.chain_weight / 2)
+            (chain_displacement, chain_energy) = attraction(
+                pos, k, numpy.concatenate((sources, targets)), numpy.concatenate((targets, sources)), weights
+            )
+            displacement += chain_displacement
+            energy += chain_energy
+        return displacement, energy
+
+    def connected_components(self, A: scipy.sparse.csr_array) -> numpy.ndarray:
+        """
+        Connected component of each node of A, and of the center as the last entry, counting chain links and the pull
+        of the center as edges.
+        """
+        num_nodes = A.shape[0]
+        is_pulled = numpy.flatnonzero(self.center_weights != 0)
+        links = scipy.sparse.coo_array(abs(A) + abs(self.to_chain_matrix()))
+        links = scipy.sparse.coo_array(
+            (
+                numpy.ones(links.nnz + len(is_pulled)),
+                (numpy.concatenate((links.row, is_pulled)), numpy.concatenate((links.col, numpy.full(len(is_pulled), num_nodes))))
+            ),
+            shape=(num_nodes + 1, num_nodes + 1)
+        )
+        (_, components) = scipy.sparse.csgraph.connected_components(links, directed=False)
+        return components
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def match_heavy_edges(A: scipy.sparse.csr_array, seed: int) -> numpy.ndarray:
+    """
+    Greedily pair up nodes with the neighbour they share the heaviest edge with, visiting nodes in (seeded) random
+    order; weights of both directions are added up.
+    Returns the cluster (pair or single node) of each node, numbered in order of their first node.
+    """
+    num_nodes = A.shape[0]
+    A = scipy.sparse.csr_array(abs(A) + abs(A).T)
+    partners = numpy.arange(num_nodes)
+    is_matched = numpy.zeros(num_nodes, dtype=bool)
+
+    order = list(range(num_nodes))
+    random.Random(seed).shuffle(order)
+    for node in order:
+        if is_matched[node]:
+            continue
+        neighbors = A.indices[A.indptr[node]:A.indptr[node + 1]]
+        weights = A.data[A.indptr[node]:A.indptr[node + 1]]
+        is_candidate = ~is_matched[neighbors] & (neighbors != node)
+        if not is_candidate.any():
+            continue
+        partner = neighbors[is_candidate][numpy.argmax(weights[is_candidate])]
+        partners[node] = partner
+        partners[partner] = node
+        is_matched[node] = is_matched[partner] = True
+
+    (_, clusters) = numpy.unique(numpy.minimum(numpy.arange(num_nodes), partners), return_inverse=True)
+    return clusters
+
+
+def coarsen(
+        A: scipy.sparse.csr_array,
+        masses: numpy.ndarray,
+        virtual_forces: VirtualForces,
+        clusters: numpy.ndarray
+    ) -> tuple[scipy.sparse.csr_array, numpy.ndarray, VirtualForces]:
+    """
+    Collapse each cluster of the graph into a single node, with the total mass of the cluster and the total weight of
+    the edges (and chain links) between clusters. Edges within a cluster are dropped.
+    """
+    num_clusters = int(clusters.max()) + 1
+    P = scipy.sparse.csr_array((numpy.ones(len(clusters)), (numpy.arange(len(clusters)), clusters)), shape=(len(clusters), num_clusters))
+    coarse_A = scipy.sparse.csr_array(P.T @ (A + virtual_forces.to_chain_matrix()) @ P)
+    coarse_A.setdiag(0)
+    coarse_A.eliminate_zeros()
+    return coarse_A, numpy.bincount(clusters, weights=masses), virtual_forces.coarsen(clusters)
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def spring_layout(
+        A: scipy.sparse.csr_array,
+        pos: numpy.ndarray,
+        virtual_forces: VirtualForces,
+        k: float,
+        iterations: int,
+        masses: typing.Union[numpy.ndarray, None] = None,
+        gravity: float = 1.0,
+        threshold: float = 1.0e-4
+    ) -> numpy.ndarray:
+    """
+    Position the nodes of weighted adjacency matrix A by Fruchterman-Reingold force-directed placement, starting from
+    pos, with virtual_forces (center and chains) on top of the forces of A's edges.
+    Same as networkx.spring_layout on large graphs (method="energy"): edges pull both of their nodes together by the
+    mean absolute weight of both directions, every connected component is pulled towards (0.5, 0.5) by gravity, and the
+    energy of all these forces is minimized by L-BFGS for up to iterations steps, or until no part of its gradient is
+    above threshold. Repulsion is approximated on a grid hierarchy for graphs with more than EXACT_REPULSION_MAX_NODES nodes.
+    Nodes repel others in proportion to their mass (1 if not given), and are pulled by gravity in proportion to it.
+    """
+    num_nodes = len(pos)
+    pos = numpy.array(pos, dtype=numpy.float64)
+    if num_nodes == 0:
+        return pos
+
+    components = virtual_forces.connected_components(A)
+    A = abs(scipy.sparse.csr_array(A, dtype=numpy.float64))
+    A = ((A + A.T) / 2).tocoo()
+    (sources, targets, weights) = (A.row.astype(numpy.int64), A.col.astype(numpy.int64), A.data)
+    repulsion = exact_repulsion if num_nodes + 1 <= EXACT_REPULSION_MAX_NODES else grid_repulsion
+
+    # The center takes part in repulsion and gravity as one more node (of mass 1) that never moves
+    masses = numpy.ones(num_nodes) if masses is None else numpy.asarray(masses, dtype=numpy.float64)
+    masses = numpy.append(masses, 1.0)
+    component_masses = numpy.bincount(components, weights=masses)
+
+    def energy(x: numpy.ndarray) -> tuple[float, numpy.ndarray]:
+        """
+        Energy of the layout with node positions x (flattened), as networkx defines it, and its gradient; the forces
+        above are half of its downhill slope.
+        """
+        pos = x.reshape(num_nodes, 2)
+        all_pos = numpy.vstack((pos, virtual_forces.center))
+        centroids = numpy.column_stack((
+            numpy.bincount(components, weights=masses * all_pos[:, 0]),
+            numpy.bincount(components, weights=masses * all_pos[:, 1])
+        )) / component_masses[:, numpy.newaxis]
+        offsets = centroids - 0.5
+
+        (displacement, potential) = repulsion(all_pos, k, masses)
+        displacement = masses[:num_nodes, numpy.newaxis] * (displacement[:num_nodes] - (gravity / 2) * offsets[components[:num_nodes]])
+        (edge_displacement, edge_energy) = attraction(pos, k, sources, targets, weights)
+        (virtual_displacement, virtual_energy) = virtual_forces.attraction(pos, k)
+        displacement += edge_displacement + virtual_displacement
+
+        cost = (masses * potential).sum() + edge_energy + virtual_energy
+        cost += (gravity / 2) * (component_masses * (offsets**2).sum(axis=1)).sum()
+        return cost, -2 * displacement.ravel()
+
+    result = scipy.optimize.minimize(
+        energy, pos.ravel(), method="L-BFGS-B", jac=True, options={"maxiter": iterations, "gtol": threshold}
+    )
+    return result.x.reshape(num_nodes, 2)
+
+
+def refine_layout(
+        A: scipy.sparse.csr_array,
+        pos: numpy.ndarray,
+        virtual_forces: VirtualForces,
+        k: float,
+        iterations: int,
+        masses: typing.Union[numpy.ndarray, None] = None
+    ) -> numpy.ndarray:
+    """
+    Improve an already good layout with spring_layout; as it starts out close to a minimum of its energy, only a
+    fraction of iterations are run.
+    """
+    return spring_layout(A, pos, virtual_forces, k, max(1, iterations // REFINE_ITERATIONS_DIVISOR), masses=masses)
+
+
+def place_new_nodes(A: scipy.sparse.csr_array, pos: numpy.ndarray, is_placed: numpy.ndarray, k: float, seed: int) -> numpy.ndarray:
+    """
+    Place every node that isn't placed yet at the centroid of its placed neighbours in A (in either direction), nudged
+    by a fraction of the spring length; nodes placed this way count as placed for their own neighbours in turn.
+    Nodes with no placed node in reach are spread randomly over the placed nodes' bounding box.
+    """
+    rng = numpy.random.RandomState(seed)
+    pos = numpy.array(pos, dtype=numpy.float64)
+    is_placed = numpy.array(is_placed, dtype=bool)
+    if not is_placed.any():
+        return pos
+
+    is_linked = A != 0
+    A = scipy.sparse.csr_array(is_linked + is_linked.T, dtype=numpy.float64)
+    (lower, upper) = (pos[is_placed].min(axis=0), pos[is_placed].max(axis=0))
+
+    while True:
+        num_placed_neighbors = A @ is_placed.astype(numpy.float64)
+        can_place = ~is_placed & (num_placed_neighbors > 0)
+        if not can_place.any():
+            break
+
+        placed_neighbor_sums = A @ numpy.where(is_placed[:, numpy.newaxis], pos, 0.0)
+        pos[can_place] = placed_neighbor_sums[can_place] / num_placed_neighbors[can_place, numpy.newaxis]
+        pos[can_place] += (rng.rand(int(can_place.sum()), 2) - 0.5) * (k * NUDGE_FACTOR)
+        is_placed |= can_place
+
+    pos[~is_placed] = lower + rng.rand(int((~is_placed).sum()), 2) * (upper - lower)
+    return pos
+
+
+def multilevel_layout(
+        A: scipy.sparse.csr_array,
+        pos: numpy.ndarray,
+        virtual_forces: VirtualForces,
+        k: float,
+        iterations: int,
+        seed: int
+    ) -> numpy.ndarray:
+    """
+    Position the nodes of weighted adjacency matrix A like spring_layout, but coarsen-and-refine: repeatedly collapse
+    pairs of heavily connected nodes (e.g. neighbours in rank range chains) into single, heavier nodes, lay out the
+    coarsest graph first, then place the nodes of every finer level at their cluster and refine.
+    The coarsest graph gets iterations; finer ones start from an already good layout, so they are only refined (see
+    refine_layout).
+    """
+    rng = numpy.random.RandomState(seed)
+    levels = [(scipy.sparse.csr_array(A, dtype=numpy.float64), numpy.ones(len(pos)), virtual_forces, numpy.asarray(pos, dtype=numpy.float64))]
+    clusterings = []
+
+    while len(levels[-1][1]) > COARSEST_MAX_NODES:
+        (level_A, level_masses, level_virtual_forces, level_pos) = levels[-1]
+        clusters = match_heavy_edges(level_A + level_virtual_forces.to_chain_matrix(), seed)
+        if clusters.max() + 1 > (1 - COARSEN_MIN_SHRINK) * len(clusters):
+            break
+
+        (coarse_A, coarse_masses, coarse_virtual_forces) = coarsen(level_A, level_masses, level_virtual_forces, clusters)
+
+        # Coarse nodes start at the centroid of the nodes they hold
+        coarse_pos = numpy.column_stack((
+            numpy.bincount(clusters, weights=level_masses * level_pos[:, 0]),
+            numpy.bincount(clusters, weights=level_masses * level_pos[:, 1])
+        )) / coarse_masses[:, numpy.newaxis]
+
+        levels.append((coarse_A, coarse_masses, coarse_virtual_forces, coarse_pos))
+        clusterings.append(clusters)
+
+    print(f"Laying out {len(levels)} levels, from {len(levels[-1][1])} to {len(pos)} nodes...")
+    (coarse_A, coarse_masses, coarse_virtual_forces, coarse_pos) = levels[-1]
+    pos = spring_layout(coarse_A, coarse_pos, coarse_virtual_forces, k, iterations, masses=coarse_masses)
+
+    for clusters, (level_A, level_masses, level_virtual_forces, _) in zip(reversed(clusterings), reversed(levels[:-1])):
+        # Nodes of the same cluster start at the same spot, so nudge them apart (by a fraction of the spring length)
+        start_pos = pos[clusters] + (rng.rand(len(clusters), 2) - 0.5) * (k * NUDGE_FACTOR)
+        pos = refine_layout(level_A, start_pos, level_virtual_forces, k, iterations, masses=level_masses)
+
+    return pos
+
+#################################################################################################################################################
+#################################################################################################################################################
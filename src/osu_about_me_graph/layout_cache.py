@@ -0,0 +1,52 @@
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS positions (
+    username TEXT PRIMARY KEY,
+    x REAL NOT NULL,
+    y REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+class LayoutCache:
+    """
+    SQLite-backed storage for the node positions of the last graph layout, keyed by username, along with the (JSON)
+    parameters the layout was made with. Positions are only handed out for the same parameters, since a layout made
+    with different forces is no good starting point.
+    """
+    def __init__(self, filename: str):
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def load_positions(self, params: dict) -> dict[str, tuple[float, float]]:
+        """
+        Return the last saved position of every user, or nothing if they were laid out with different parameters.
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if row is None or json.loads(row[0]) != params:
+            return {}
+        return {username: (x, y) for username, x, y in self.conn.execute("SELECT username, x, y FROM positions")}
+
+    def save_positions(self, params: dict, positions: dict[str, tuple[float, float]]) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM positions")
+            self.conn.executemany(
+                "INSERT INTO positions (username, x, y) VALUES (?, ?, ?)",
+                [(username, float(x), float(y)) for username, (x, y) in positions.items()]
+            )
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('params', ?)", (json.dumps(params, sort_keys=True),))
+
+#################################################################################################################################################
+#################################################################################################################################################
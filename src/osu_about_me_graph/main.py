@@ -1,4 +1,5 @@
 from . import args
+from . import classes
 from .generate_graph import generate_graph
 from .graph_analysis_report import graph_analysis_report
 from .parse_users import parse_users
@@ -42,14 +43,19 @@ async def main() -> None:
     args.parse_arguments()
 
     save_json = args.ARGS.save_json
-    big_nodes_closer = args.ARGS.big_nodes_closer
+    fresh_layout = args.ARGS.fresh_layout
+    incremental = args.ARGS.incremental
+    multilevel_layout = args.ARGS.multilevel_layout
     no_analysis_report = args.ARGS.no_analysis_report
     no_graph = args.ARGS.no_graph
     no_legend = args.ARGS.no_legend
+    resume = args.ARGS.resume
     use_last_run = args.ARGS.use_last_run
     verbose = args.ARGS.verbose
 
+    analysis_workers = args.ARGS.analysis_workers
     arrow_size = args.ARGS.arrow_size
+    betweenness_samples = args.ARGS.betweenness_samples
     centrality_weight_factor = args.ARGS.centrality_weight
     dpi = args.ARGS.dpi
     edge_curvature = args.ARGS.edge_curvature
@@ -58,8 +64,10 @@ async def main() -> None:
     fp_min_followers = args.ARGS.fp_min_followers
     fp_max_followers = args.ARGS.fp_max_followers
     fp_mentions_top_percentile = args.ARGS.fp_mentions_top_percentile
+    fp_sort_by = args.ARGS.fp_sort_by
     gamemode = args.ARGS.gamemode
     image_width = args.ARGS.image_width
+    incremental_refresh_percent = args.ARGS.incremental_refresh_percent
     iterations = args.ARGS.iterations
     legend_font_size = args.ARGS.legend_font_size
     max_node_diameter = args.ARGS.max_node_diameter
@@ -67,15 +75,25 @@ async def main() -> None:
     max_label_size = args.ARGS.max_label_size
     min_label_size = args.ARGS.min_label_size
     num_users = args.ARGS.num_users
+    parse_workers = args.ARGS.parse_workers
     rank_range_clustering_weight = args.ARGS.rank_range_clustering_weight
     rank_range_connection_strength = args.ARGS.rank_range_connection_strength
     rank_range_size = args.ARGS.rank_range_size
+    report_top_k = args.ARGS.report_top_k
+    request_burst = args.ARGS.request_burst
+    requests_per_sec = args.ARGS.requests_per_sec
     spring_force = args.ARGS.spring_force
     start_rank = args.ARGS.start_rank
 
-    save_filename = "users.pkl"
+    save_filename = "users.db"
+    legacy_save_filename = "users.pkl"
+    parse_cache_filename = "parse_cache.db"
+    matcher_filename = "username_matcher.bin"
+    analysis_cache_filename = "analysis_cache_" + gamemode.value + ".db"
+    layout_cache_filename = "layout_cache_" + gamemode.value + ".db"
     report_filename = "false_positives.md"
     analysis_report_filename = "graph_analysis.md"
+    analysis_csv_filename = "graph_analysis.csv"
     ignore_usernames_filename = "ignore_usernames.txt"
     image_filename = "user_network.png"
     json_filename = "html/graph_data_" + gamemode.value + ".json"
@@ -91,58 +109,81 @@ async def main() -> None:
         logger.setLevel(logging.INFO)
 
     # Get API data
-    users, scrape_min = await async_timer(
+    store, scrape_min = await async_timer(
         scrape_users,
             start_rank,
             num_users,
             gamemode,
             use_last_run,
-            save_filename
+            save_filename,
+            legacy_save_filename,
+            requests_per_sec,
+            request_burst,
+            incremental,
+            incremental_refresh_percent,
+            resume
     )
 
+    # Index users once for every stage that needs to look them up
+    user_index = classes.UserIndex(store.load_last_run_summaries())
+
     # Parse API data
-    (mentions_graph, username_to_rank), parse_min = sync_timer(
+    (mentions_graph, username_to_rank, mention_index), parse_min = sync_timer(
         parse_users,
-            users,
+            store,
+            user_index,
             ignore_usernames_filename,
             save_json,
-            json_filename
+            json_filename,
+            parse_workers,
+            parse_cache_filename,
+            matcher_filename
     )
 
     # Generate false-positives report
     _, report_false_positives_min = sync_timer(
         report_false_positives,
-            users,
+            user_index,
             mentions_graph,
+            mention_index,
             fp_mentions_top_percentile,
             fp_min_followers,
             fp_max_followers,
+            fp_sort_by,
             report_filename,
             ignore_usernames_filename
     )
 
-    # Clean up before explode PC
-    del users
+    # Clean up before explode PC; later stages only need the (much smaller) frozen graph
+    frozen_graph = mentions_graph.freeze()
+    store.close()
+    del mentions_graph, mention_index, user_index
     gc.collect()
 
     # Generate graph analysis report
     _, graph_analysis_report_min = sync_timer(
         graph_analysis_report,
-            mentions_graph,
+            frozen_graph,
             analysis_report_filename,
-            no_analysis_report
+            analysis_csv_filename,
+            no_analysis_report,
+            analysis_workers,
+            betweenness_samples,
+            analysis_cache_filename,
+            report_top_k
     )
 
     # Generate graph
     _, graphgen_min = sync_timer(
         generate_graph,
-            mentions_graph,
+            frozen_graph,
             username_to_rank,
             spring_force,
             iterations,
+            multilevel_layout,
+            fresh_layout,
             image_width,
             dpi,
-            big_nodes_closer,
             centrality_weight_factor,
             min_node_diameter,
             max_node_diameter,
@@ -157,7 +198,8 @@ async def main() -> None:
             legend_font_size,
             no_graph,
             no_legend,
-            image_filename
+            image_filename,
+            layout_cache_filename
     )
 
     # Print stuff
@@ -166,7 +208,7 @@ async def main() -> None:
     if not no_graph:
         print(f"You can find the image at \"{image_filename}\"")
     if not no_analysis_report:
-        print(f"You can find graph analysis values at \"{analysis_report_filename}\"")
+        print(f"You can find graph analysis values at \"{analysis_report_filename}\" (every user's scores are in \"{analysis_csv_filename}\")")
     print(f"Ignored usernames can be found at \"{ignore_usernames_filename}\"")
     print(f"Possible false-positives can be found at \"{report_filename}\"")
     if not use_last_run:
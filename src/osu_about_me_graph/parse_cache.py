@@ -0,0 +1,151 @@
+import hashlib
+import json
+import sqlite3
+import time
+import typing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parse_spans (
+    content_hash TEXT PRIMARY KEY,
+    alias_fingerprint TEXT NOT NULL,
+    spans TEXT NOT NULL,
+    used_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS alias_sets (
+    fingerprint TEXT PRIMARY KEY,
+    aliases TEXT NOT NULL
+);
+"""
+
+# Entries that no run has used for this long are dropped
+CACHE_EXPIRY_SEC = 30 * 24 * 60 * 60
+
+# Up to this many aliases added since an entry was cached are searched for directly (with str.find) instead of re-parsing the page
+MAX_DELTA_ALIASES = 100
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def fingerprint_aliases(aliases: list[str]) -> str:
+    return hashlib.sha256("\n".join(sorted(aliases)).encode("utf-8")).hexdigest()
+
+
+def find_bounded_matches(document: str, words: typing.Iterable[str]) -> list[tuple[int, int]]:
+    """
+    Same as classes.CompactTrie.find_matches, but searches for each word separately.
+    Faster than walking the whole document down the trie when there are only a few words.
+    """
+    document = document.lower()
+    matches = []
+    for word in words:
+        start = document.find(word)
+        while start != -1:
+            end = start + len(word)
+            if (start == 0 or not document[start - 1].isalnum()) and (end == len(document) or not document[end].isalnum()):
+                matches.append((start, len(word)))
+            start = document.find(word, start + 1)
+    return matches
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+class ParseCache:
+    """
+    SQLite-backed cache of parse results, mapping the hash of an about me page to the (start index, length) span of
+    every bounded alias match in it.
+    Each entry remembers which alias set it was computed with. When the alias set changes (new users, new ignored
+    usernames, ...), entries are patched rather than thrown away; matches of removed aliases are dropped, and added
+    aliases are searched for directly if there aren't too many of them.
+    """
+    def __init__(self, filename: str, aliases: list[str]):
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+
+        self.aliases = frozenset(aliases)
+        self.fingerprint = fingerprint_aliases(aliases)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO alias_sets (fingerprint, aliases) VALUES (?, ?)",
+                (self.fingerprint, json.dumps(sorted(self.aliases)))
+            )
+
+        # Old alias set fingerprint -> (removed aliases, added aliases), or None if too many were added
+        self.deltas = {}
+
+        self.num_hits = 0
+        self.num_patched = 0
+        self.num_misses = 0
+
+    def close(self) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM parse_spans WHERE used_at < ?", (time.time() - CACHE_EXPIRY_SEC,))
+            self.conn.execute("DELETE FROM alias_sets WHERE fingerprint NOT IN (SELECT DISTINCT alias_fingerprint FROM parse_spans) AND fingerprint != ?", (self.fingerprint,))
+        self.conn.close()
+
+    def get_delta(self, old_fingerprint: str) -> typing.Union[tuple[frozenset, frozenset], None]:
+        if old_fingerprint not in self.deltas:
+            row = self.conn.execute("SELECT aliases FROM alias_sets WHERE fingerprint = ?", (old_fingerprint,)).fetchone()
+            if row is None:
+                self.deltas[old_fingerprint] = None
+            else:
+                old_aliases = frozenset(json.loads(row[0]))
+                added = self.aliases - old_aliases
+                removed = old_aliases - self.aliases
+                self.deltas[old_fingerprint] = (removed, added) if len(added) <= MAX_DELTA_ALIASES else None
+        return self.deltas[old_fingerprint]
+
+    def get_many(self, pages: list[tuple[str, str]]) -> list[typing.Union[list[tuple[int, int]], None]]:
+        """
+        Look up (content hash, about me) pages. Returns the matches of each page, or None if it has to be parsed.
+        Patched entries are written back under the current alias set.
+        """
+        content_hashes = [content_hash for content_hash, _ in pages]
+        placeholders = ",".join("?" * len(content_hashes))
+        entries = {
+            content_hash: (alias_fingerprint, spans)
+            for content_hash, alias_fingerprint, spans in self.conn.execute(
+                f"SELECT content_hash, alias_fingerprint, spans FROM parse_spans WHERE content_hash IN ({placeholders})",
+                content_hashes
+            )
+        }
+
+        results = []
+        patched = []
+        for content_hash, about_me in pages:
+            entry = entries.get(content_hash)
+            delta = self.get_delta(entry[0]) if entry is not None and entry[0] != self.fingerprint else None
+
+            if entry is None or (entry[0] != self.fingerprint and delta is None):
+                self.num_misses += 1
+                results.append(None)
+                continue
+
+            matches = [(start, length) for start, length in json.loads(entry[1])]
+            if entry[0] == self.fingerprint:
+                self.num_hits += 1
+            else:
+                (removed, added) = delta
+                if removed:
+                    page = about_me.lower()
+                    matches = [(start, length) for start, length in matches if page[start:start + length] not in removed]
+                matches += find_bounded_matches(about_me, added)
+                matches.sort()
+                patched.append((content_hash, matches))
+                self.num_patched += 1
+            results.append(matches)
+
+        self.put_many(patched)
+        with self.conn:
+            self.conn.executemany("UPDATE parse_spans SET used_at = ? WHERE content_hash = ?", [(time.time(), content_hash) for content_hash in content_hashes])
+        return results
+
+    def put_many(self, entries: list[tuple[str, list[tuple[int, int]]]]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO parse_spans (content_hash, alias_fingerprint, spans, used_at) VALUES (?, ?, ?, ?)",
+                [(content_hash, self.fingerprint, json.dumps(matches), time.time()) for content_hash, matches in entries]
+            )
+
+#################################################################################################################################################
+#################################################################################################################################################
@@ -1,7 +1,22 @@
 from . import classes
+from . import parse_cache
+from . import user_store
 
+import collections
+import concurrent.futures
+import itertools
 import json
 import os
+import typing
+
+# Number of about me pages handed to a worker process at once
+PARSE_CHUNK_SIZE = 250
+
+# Snippets of lines longer than this are cut down to a window around the mention
+SNIPPET_MAX_CHARS = 200
+
+# Matcher of the current worker process; memory-mapped once per worker by init_parse_worker rather than sent with every chunk
+WORKER_MATCHER = None
 
 #################################################################################################################################################
 #################################################################################################################################################
@@ -17,9 +32,34 @@ def get_ignored_usernames(ignore_usernames_filename: str) -> list[str]:
         return ignored_usernames
 
 
-def save_to_json(mentions_graph: classes.DirectedGraph, users: list[dict], ignored_usernames: list[str], json_out_filename: str) -> None:
+def map_to_utf16(page: str) -> tuple[list[int], list[int]]:
+    """
+    Where the offsets that mentions are found at (in page.lower()) are in page itself: the index of the character of
+    page that each character of page.lower() was lowercased from, and the offset of each character of page (and of its
+    end) in UTF-16 code units. Lowercasing can turn one character into several ("İ"), and characters outside the BMP
+    take up two code units.
+    """
+    source_chars = [i for i, char in enumerate(page) for _ in char.lower()]
+    utf16_offsets = list(itertools.accumulate((2 if ord(char) > 0xFFFF else 1 for char in page), initial=0))
+    return source_chars, utf16_offsets
+
+
+def save_to_json(
+        mentions_graph: classes.DirectedGraph,
+        mention_index: classes.MentionIndex,
+        store: user_store.UserStore,
+        ignored_usernames: list[str],
+        json_out_filename: str
+    ) -> None:
+    """
+    Save the graph for the web viewer. Each edge lists the alias, offset and length of its mentions only; the text
+    around a mention can be found in the mentioner's about me page, which is saved with its node. Offsets and lengths
+    are in UTF-16 code units of the saved page, like JavaScript string indices.
+    """
     nodes = []
-    for user in users:
+    about_mes = {}
+    for user in store.iter_last_run_users(include_about_me=True):
+        about_mes[user["current_username"]] = user["about_me"]
         nodes.append({
             "data": {
                 "id": user["current_username"],
@@ -33,12 +73,20 @@ def save_to_json(mentions_graph: classes.DirectedGraph, users: list[dict], ignor
 
     edges = []
     for source_node, target_nodes in mentions_graph.adj.items():
+        (source_chars, utf16_offsets) = map_to_utf16(about_mes[source_node])
         for target_node in target_nodes:
+            mentions = []
+            for alias, offset, _ in mention_index.get_mentions(source_node, target_node):
+                start = utf16_offsets[source_chars[offset]]
+                end = utf16_offsets[source_chars[offset + len(alias) - 1] + 1]
+                mentions.append({"alias": alias, "offset": start, "length": end - start})
+
             edges.append({
                 "data": {
                     "id": f"{source_node}*{target_node}",
                     "source": source_node,
                     "target": target_node,
+                    "mentions": mentions
                 }
             })
 
@@ -51,94 +99,200 @@ def save_to_json(mentions_graph: classes.DirectedGraph, users: list[dict], ignor
     with open(json_out_filename, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4, sort_keys=True)
 
+def get_snippet(page: str, start: int, end: int) -> str:
+    """
+    Return the line of page containing page[start:end], cut down to SNIPPET_MAX_CHARS around it if the line is longer.
+    """
+    line_start = page.rfind("\n", 0, start) + 1
+    line_end = page.find("\n", end)
+    line_end = line_end if line_end != -1 else len(page)
+
+    if line_end - line_start > SNIPPET_MAX_CHARS:
+        margin = max(0, SNIPPET_MAX_CHARS - (end - start)) // 2
+        line_start = max(line_start, start - margin)
+        line_end = min(line_end, end + margin)
+
+    return page[line_start:line_end]
+
+
+def find_mentions(matcher: classes.CompactTrie, about_mes: list[str]) -> list[list[tuple[int, int]]]:
+    """
+    Return every (start index, length) alias match on each of a list of about me pages, in page order.
+    """
+    return matcher.find_matches_many(about_mes)
+
+
+def init_parse_worker(matcher_filename: str, fingerprint: str) -> None:
+    global WORKER_MATCHER
+    WORKER_MATCHER = classes.CompactTrie.load(matcher_filename, fingerprint)
+
+
+def find_mentions_in_worker(about_mes: list[str]) -> list[list[tuple[int, int]]]:
+    return find_mentions(WORKER_MATCHER, about_mes)
+
+
+def iter_page_chunks(store: user_store.UserStore) -> typing.Iterator[list[tuple[str, str, str]]]:
+    chunk = []
+    for page in store.iter_last_run_about_me():
+        chunk.append(page)
+        if len(chunk) == PARSE_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_mentions(
+        store: user_store.UserStore,
+        matcher: classes.CompactTrie,
+        matcher_filename: str,
+        cache: parse_cache.ParseCache,
+        parse_workers: int
+    ) -> typing.Iterator[tuple[list[str], list[list[tuple[str, int, str]]]]]:
+    """
+    Find mentions in every about me page of the store's last run, one chunk of pages at a time.
+    Yields the usernames of each chunk and the mentions on each of its pages, as (alias, offset, snippet) sorted by alias.
+    Offsets index into the lowercased page, where each alias is first mentioned.
+    Pages found in the cache skip matching; the rest are matched and added to it.
+    If parse_workers > 1, chunks are spread across that many processes, each of which memory-maps the matcher saved in
+    matcher_filename; results are still yielded in page order.
+    """
+    def finish_chunk(
+            chunk: list[tuple[str, str, str]],
+            cached: list[typing.Union[list[tuple[int, int]], None]],
+            parsed: list[list[tuple[int, int]]]
+        ) -> tuple[list[str], list[list[tuple[str, int, str]]]]:
+        parsed = iter(parsed)
+        new_entries = []
+        for i, (_, content_hash, _) in enumerate(chunk):
+            if cached[i] is None:
+                cached[i] = next(parsed)
+                new_entries.append((content_hash, cached[i]))
+        cache.put_many(new_entries)
+
+        usernames = [current_username for current_username, _, _ in chunk]
+        mentions = []
+        for (_, _, about_me), matches in zip(chunk, cached):
+            page = about_me.lower() if matches else about_me
+            first_starts = classes.CompactTrie.first_longest_matches(page, matches)
+            mentions.append([
+                (alias, start, get_snippet(page, start, start + len(alias)))
+                for alias, start in sorted(first_starts.items())
+            ])
+        return usernames, mentions
+
+    def split_chunk(chunk: list[tuple[str, str, str]]) -> tuple[list, list[str]]:
+        cached = cache.get_many([(content_hash, about_me) for _, content_hash, about_me in chunk])
+        misses = [about_me for (_, _, about_me), matches in zip(chunk, cached) if matches is None]
+        return cached, misses
+
+    if parse_workers <= 1:
+        for chunk in iter_page_chunks(store):
+            cached, misses = split_chunk(chunk)
+            yield finish_chunk(chunk, cached, find_mentions(matcher, misses))
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers, initializer=init_parse_worker, initargs=(matcher_filename, cache.fingerprint)) as executor:
+        # Only keep a couple of chunks per worker in flight, so that pages are still streamed from the store
+        in_flight = collections.deque()
+        for chunk in iter_page_chunks(store):
+            cached, misses = split_chunk(chunk)
+            in_flight.append((chunk, cached, executor.submit(find_mentions_in_worker, misses)))
+            if len(in_flight) >= 2 * parse_workers:
+                chunk, cached, future = in_flight.popleft()
+                yield finish_chunk(chunk, cached, future.result())
+
+        while in_flight:
+            chunk, cached, future = in_flight.popleft()
+            yield finish_chunk(chunk, cached, future.result())
+
 #################################################################################################################################################
 #################################################################################################################################################
 
 def parse_users(
-        users: list[dict],
+        store: user_store.UserStore,
+        user_index: classes.UserIndex,
         ignore_usernames_filename: str,
         save_json: bool,
-        json_filename: str
-    ) -> tuple[classes.DirectedGraph, dict]:
+        json_filename: str,
+        parse_workers: int,
+        parse_cache_filename: str,
+        matcher_filename: str
+    ) -> tuple[classes.DirectedGraph, dict, classes.MentionIndex]:
     """
     Parse user about me pages. Returns a tuple containing the following:
         * Undirected graph, where an edge exists between player A and B iff player A mentions player B.
         * Map from (current) username to global rank.
+        * Index of where each mention was found, i.e. the alias used, its offset and the line around it.
     Usernames found in specified txt file will not contribute to mention data for the associated user.
+    Only the users of the store's last run are parsed; about me pages are streamed from the store in chunks, which are
+    matched across parse_workers processes if it is greater than 1. The result is the same for any number of workers.
+    Matches are cached in parse_cache_filename by page content and alias set, so unchanged pages are only parsed once.
+    The compiled alias matcher is saved to matcher_filename and reused by later runs with the same alias set.
     """
-    print(f"\n--- Parsing data for {len(users)} users...")
-    alias_to_current = {}
+    print(f"\n--- Parsing data for {len(user_index)} users...")
     current_to_rank = {}
     mentions_graph = classes.DirectedGraph()
-    username_trie = classes.Trie()
+    mention_index = classes.MentionIndex()
+    matched_aliases = set()
 
     # Get ignored usernames if they exist
     ignored_usernames = get_ignored_usernames(ignore_usernames_filename)
+    ignored_usernames_set = set(ignored_usernames or [])
     ignored_username_hits = 0
 
     print("Building storage structures...")
 
-    # Sort by follower count (descending), then rank (ascending) in the case of ties
-    users = sorted(users, key=lambda user: (-user["follower_count"], user["global_rank"]), reverse=False)
-    for user in users:
-        # Populate username mapping with past and present usernames. Someone's current username could be
-        # another's past username. To deal with these conflicts, pick user with higher follower count (or
-        # rank during ties). We sorted the list as such above so we just have to check "not in".
-        current_username = user["current_username"]
-        if current_username not in alias_to_current:
-            alias_to_current[current_username] = current_username
-
-        previous_usernames = user["previous_usernames"]
-
-        # Also storing "users/<UID>" as an alias, in order to account for collabs that use user ID instead of username.
-        # See: https://github.com/mbalsdon/osu-about-me-graph/issues/18
-        previous_usernames.append(f"users/{user['user_id']}")
+    for user in user_index:
+        current_to_rank[user["current_username"]] = user["global_rank"]
 
-        for previous_username in previous_usernames:
-            if previous_username not in alias_to_current:
-                alias_to_current[previous_username] = current_username
-
-        current_to_rank[current_username] = user["global_rank"]
-
-        if current_username in ignored_usernames:
-            ignored_username_hits += 1
-        else:
-            username_trie.insert(current_username)
-
-        for previous_username in previous_usernames:
-            if previous_username in ignored_usernames:
+        # Aliases shared by several users are resolved by the user index (to the one with higher follower count)
+        for alias in user_index.get_aliases(user):
+            if alias in ignored_usernames_set:
                 ignored_username_hits += 1
             else:
-                username_trie.insert(previous_username)
+                matched_aliases.add(alias.lower())
 
     print(f"Found and ignored {ignored_username_hits} usernames!")
 
-    print("Parsing 'About me' pages...")
-    counter = classes.ProgressCounter(0, len(users))
+    # Compiling the matcher takes longer than parsing cached pages, so reuse the last one if nothing changed
+    aliases_fingerprint = parse_cache.fingerprint_aliases(list(matched_aliases))
+    username_matcher = classes.CompactTrie.load(matcher_filename, aliases_fingerprint)
+    if username_matcher is None:
+        print("Compiling username matcher...")
+        username_matcher = classes.CompactTrie()
+        for alias in matched_aliases:
+            username_matcher.insert(alias)
+        username_matcher.build()
+        username_matcher.save(matcher_filename, aliases_fingerprint)
 
-    for user in users:
-        current_username = user["current_username"]
-        about_me = user["about_me"]
+    print("Parsing 'About me' pages...")
+    counter = classes.ProgressCounter(0, len(user_index))
+    cache = parse_cache.ParseCache(parse_cache_filename, list(matched_aliases))
 
-        mentions_graph.add_vertex(current_username)
+    for usernames, mentions in iter_mentions(store, username_matcher, matcher_filename, cache, parse_workers):
+        for current_username, page_mentions in zip(usernames, mentions):
+            mentions_graph.add_vertex(current_username)
 
-        referenced_aliases = username_trie.find_names_in_document(about_me)
-        for referenced_alias in referenced_aliases:
-            referenced_username = alias_to_current[referenced_alias.lower()]
+            for referenced_alias, offset, snippet in page_mentions:
+                referenced_username = user_index.get_by_alias(referenced_alias)["current_username"]
 
-            if current_username != referenced_username:
-                mentions_graph.add_edge(current_username, referenced_username)
+                if current_username != referenced_username:
+                    mentions_graph.add_edge(current_username, referenced_username)
+                    mention_index.add_mention(current_username, referenced_username, referenced_alias, offset, snippet)
 
-        counter.increment()
+            counter.increment()
         counter.print_progress_bar()
 
     print("\n", end="")
+    print(f"Parse cache: {cache.num_hits} hits, {cache.num_patched} patched for the new alias set, {cache.num_misses} parsed.")
+    cache.close()
 
     if save_json:
         print(f"JSON flag was set; saving to {json_filename}...")
-        save_to_json(mentions_graph, users, ignored_usernames, json_filename)
+        save_to_json(mentions_graph, mention_index, store, ignored_usernames, json_filename)
 
-    return mentions_graph, current_to_rank
+    return mentions_graph, current_to_rank, mention_index
 
 #################################################################################################################################################
 #################################################################################################################################################
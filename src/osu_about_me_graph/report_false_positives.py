@@ -1,65 +1,76 @@
 from . import classes
 
+import numpy
+
 import random
 
+# Number of usage examples shown for each suspicious user
+NUM_USAGE_EXAMPLES = 10
+
+# Usage examples are sampled with a fixed seed (per user), so that re-generating the report gives the same examples
+USAGE_EXAMPLES_SEED = 727
+
 #################################################################################################################################################
 #################################################################################################################################################
 
-def find_bounded_substring(text: str, substring: str, delimiter: str) -> str:
+def select_top_k(scores: numpy.ndarray, usernames: list[str], k: int) -> list[int]:
     """
-    Find the text containing substring bounded by delimiter.
-    If no delimiter is found, extends to start/end of string.
+    Return the indices of the k highest scores, ordered by score (descending), then username (ascending).
+    The cut is found by partitioning, so only the top k are ever sorted.
     """
-    pos = text.find(substring)
-    if pos == -1:
-        return None
-
-    # Find previous delimiter or start of string
-    start = text[:pos].rfind(delimiter)
-    start = start + 1 if start != -1 else 0
+    if k <= 0:
+        return []
 
-    # Find next delimiter or end of string
-    end = text[pos:].find(delimiter)
-    end = pos + end if end != -1 else len(text)
+    if k < len(scores):
+        threshold = numpy.partition(scores, len(scores) - k)[len(scores) - k]
+        above = numpy.flatnonzero(scores > threshold).tolist()
+        tied = sorted(numpy.flatnonzero(scores == threshold).tolist(), key=lambda i: usernames[i])
+        top = above + tied[:k - len(above)]
+    else:
+        top = range(len(scores))
 
-    return text[start:end]
+    return sorted(top, key=lambda i: (-scores[i], usernames[i]))
 
 #################################################################################################################################################
 #################################################################################################################################################
 
 def report_false_positives(
-        users: list[dict],
+        user_index: classes.UserIndex,
         mentions_graph: classes.DirectedGraph,
+        mention_index: classes.MentionIndex,
         mentions_top_percentile: float,
         min_followers: int,
         max_followers: int,
+        sort_by: str,
         report_filename: str,
         ignore_usernames_filename: str
     ) -> None:
     """
     Generates a file containing users in the top X% of mentions with less than Y followers\n
+    They are listed by number of mentions, or by suspicion (mentions per follower) if sort_by is "suspicion".\n
+    Usage examples are taken from the mention index built while parsing, so about me pages aren't searched again.\n
     [If I ever have to read this code again](https://c.tenor.com/MT_m5VBtBWwAAAAd/tenor.gif)
     """
-    print(f"\n--- Generating false-positives report for {len(users)} users...")
+    print(f"\n--- Generating false-positives report for {len(user_index)} users...")
 
-    username_to_followers = {}
-    usernames = [u for u in list(mentions_graph.in_degrees.keys())]
-    for username in usernames:
-        username_to_followers[username] = next((u["follower_count"] for u in users if u["current_username"] == username), None)
+    usernames = list(mentions_graph.in_degrees.keys())
+    mentions = numpy.array([mentions_graph.in_degrees[username] for username in usernames], dtype=numpy.int64)
+    followers = numpy.array([
+        user["follower_count"] if user is not None and user["follower_count"] is not None else numpy.nan
+        for user in map(user_index.get_by_username, usernames)
+    ], dtype=numpy.float64)
+    suspicion = mentions / numpy.maximum(followers, 1.0)
 
-    if (len(username_to_followers) != len(mentions_graph.in_degrees)):
-        raise AssertionError(f"{len(username_to_followers)} != {len(mentions_graph.in_degrees)}")
+    # Get top X% of mentions, ordered by mentions (desc)
+    num_elmts = round(len(usernames) * (mentions_top_percentile / 100))
+    most_mentioned = select_top_k(mentions, usernames, num_elmts)
 
-    # Get top X% of mentions - by sorting (desc) and accessing first X% elements
-    mentions_list_desc = [u[0] for u in sorted(mentions_graph.in_degrees.items(), key=lambda user: (-user[1], user[0]), reverse=False)]
-    num_elmts = round(len(username_to_followers) * (mentions_top_percentile / 100))
-    most_mentioned = mentions_list_desc[:num_elmts]
+    # Keep those with followcounts within threshold (maintain order of mentions)
+    followers_within_threshold = (followers >= min_followers) & (followers <= max_followers)
+    possible_common_word_ids = [i for i in most_mentioned if followers_within_threshold[i]]
 
-    # Get followcounts under threshold
-    followers_under_threshold = [u[0] for u in username_to_followers.items() if u[1] >= min_followers and u[1] <= max_followers]
-
-    # Find users common to both lists (maintain order of mentions)
-    possible_common_word_usernames = [username for username in most_mentioned if username in set(followers_under_threshold)]
+    if sort_by == "suspicion":
+        possible_common_word_ids = sorted(possible_common_word_ids, key=lambda i: suspicion[i], reverse=True)
 
     # Build report
     lines = [
@@ -74,6 +85,8 @@ def report_false_positives(
         f"* Are in the top {mentions_top_percentile}% of mentions",
         f"* Have at least {min_followers} and at most {max_followers} followers",
         "",
+        f"They are listed by {'suspicion score (mentions per follower)' if sort_by == 'suspicion' else 'number of mentions'}, highest first.",
+        "",
         "You can tweak these values and re-generate this report by running with additional flags, e.g.",
         "`osu_mentions --fp-max-followers 727 --fp-mentions-top-percentile 72.7 --use-last-run --no-graph`",
         "",
@@ -86,38 +99,29 @@ def report_false_positives(
         "---",
     ]
 
-    for current_username in possible_common_word_usernames:
-        previous_usernames = [user["previous_usernames"] for user in users if user["current_username"] == current_username][0]
-        mentions = mentions_graph.in_degrees[current_username]
-        followers = username_to_followers[current_username]
+    for i in possible_common_word_ids:
+        current_username = usernames[i]
+        previous_usernames = user_index.get_by_username(current_username)["previous_usernames"]
 
         lines.append(f"**Username:** '{current_username}'")
         lines.append(f"**Previous usernames:** {previous_usernames}")
-        lines.append(f"**Number of mentions:** {mentions}")
-        lines.append(f"**Number of followers:** {followers}")
+        lines.append(f"**Number of mentions:** {mentions[i]}")
+        lines.append(f"**Number of followers:** {int(followers[i])}")
+        lines.append(f"**Suspicion score:** {suspicion[i]:.4f}")
         lines.append("")
 
-        in_edges_list = list(mentions_graph.get_in_edges(current_username))
-        random.shuffle(in_edges_list)
-
-        num_iterations = min(10, len(in_edges_list))
-        for i in range(0, num_iterations):
-            in_edges = in_edges_list[i]
-            mentioner_username = in_edges[0]
-            about_me = [user["about_me"] for user in users if user["current_username"] == mentioner_username][0]
+        mentioners = mention_index.get_mentioners(current_username)
+        rng = random.Random(f"{USAGE_EXAMPLES_SEED}:{current_username}")
 
-            usage_line = None
-            aliases = [current_username] + previous_usernames
-            for alias in aliases:
-                usage_line = find_bounded_substring(about_me.lower(), alias, "\n")
-                if usage_line != None:
-                    lines.append(f"'{mentioner_username}' mentioned '{alias}' in the following line:")
-                    lines.append(f"```\n{usage_line}\n```")
-                    lines.append("")
-                    break
+        for mentioner_username in rng.sample(mentioners, min(NUM_USAGE_EXAMPLES, len(mentioners))):
+            page_mentions = mention_index.get_mentions(mentioner_username, current_username)
+            if not page_mentions:
+                raise AssertionError(f"Could not find any mention of {current_username} in {mentioner_username}'s page!")
 
-            if usage_line == None:
-                raise AssertionError(f"Could not find any mention of {aliases} in {mentioner_username}'s page!")
+            (alias, _, usage_line) = min(page_mentions, key=lambda mention: mention[1])
+            lines.append(f"'{mentioner_username}' mentioned '{alias}' in the following line:")
+            lines.append(f"```\n{usage_line}\n```")
+            lines.append("")
 
         lines.append("")
         lines.append("---")
@@ -127,7 +131,7 @@ def report_false_positives(
     with open(report_filename, "w") as f:
         f.writelines(line + "\n" for line in lines)
 
-    print(f"Found {len(possible_common_word_usernames)} possible false-positives!")
+    print(f"Found {len(possible_common_word_ids)} possible false-positives!")
 
 #################################################################################################################################################
 #################################################################################################################################################
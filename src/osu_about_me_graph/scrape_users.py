@@ -1,9 +1,12 @@
 from . import classes
+from . import user_store
 
 import aiohttp
 import asyncio
 import ossapi
 
+import collections
+import itertools
 import logging
 import math
 import os
@@ -13,34 +16,42 @@ import typing
 
 logger = logging.getLogger("osu-about-me-graph")
 
-# osu!API v2 docs (https://osu.ppy.sh/docs/index.html#introduction) specify ratelimit of 1200 requests/min (0.05 requests/sec).
-# Be nice to peppy by staying well under that.
-MAX_REQUESTS_PER_SEC = 0.10
-
 REQUEST_TIMEOUT_SEC = 5.0
 
+RANKINGS_PAGE_SIZE = 50
+
+# Enough workers to keep the ratelimiter busy while some requests hang or back off
+NUM_USER_WORKERS = 32
+
+# A few rankings pages worth of userIDs
+USER_ID_QUEUE_SIZE = 4 * RANKINGS_PAGE_SIZE
+
+# Rankings pages requested ahead of the one being fed into the queue (they still wait on the shared ratelimiter)
+RANKINGS_PAGES_IN_FLIGHT = 4
+
 #################################################################################################################################################
 #################################################################################################################################################
 
-async def fetch_single_rankings_ids(
+async def fetch_single_rankings_page(
         osu: ossapi.OssapiAsync,
         mode: ossapi.GameMode,
         page: int,
-        initial_wait_sec: float,
-        counter: classes.ProgressCounter
-    ) -> list[int]:
+        limiter: classes.TokenBucket
+    ) -> list[dict]:
     """
-    Requests rankings from osu!API v2 and returns userIDs.
+    Requests rankings from osu!API v2 and returns the userID, username and rank of each entry.
+    Waits on the shared ratelimiter before each attempt.
     Deals with server errors using [exponential backoff](https://en.wikipedia.org/wiki/Exponential_backoff).
     """
-    await asyncio.sleep(initial_wait_sec)
-
     retries = 0
     wait_sec = 0.0
 
     while True:
         err_msg = ""
         try:
+            # Every attempt (including retries) takes a token, so backoffs don't push us over the ratelimit
+            await limiter.acquire()
+
             # Sometimes ossapi client requests will hang
             rankings = await asyncio.wait_for(
                 osu.ranking(
@@ -51,11 +62,15 @@ async def fetch_single_rankings_ids(
                 timeout=REQUEST_TIMEOUT_SEC
             )
 
-            # Race condition here, but locks are expensive and printing is not critical
-            counter.increment()
-            counter.print_progress_bar()
-
-            return [user_statistics.user.id for user_statistics in rankings.ranking]
+            logger.debug(f"Fetched rankings page {page}")
+            return [
+                {
+                    "user_id": user_statistics.user.id,
+                    "current_username": user_statistics.user.username.lower(),
+                    "global_rank": user_statistics.global_rank
+                }
+                for user_statistics in rankings.ranking
+            ]
 
         except ValueError as e:
             error_message = str(e).lower()
@@ -81,40 +96,80 @@ async def fetch_single_rankings_ids(
         continue
 
 
-async def fetch_rankings_ids(osu: ossapi.OssapiAsync, mode: ossapi.GameMode, first_page: int, num_pages: int) -> list[int]:
+async def fetch_rankings_ids(
+        osu: ossapi.OssapiAsync,
+        mode: ossapi.GameMode,
+        first_page: int,
+        num_pages: int,
+        limiter: classes.TokenBucket,
+        queue: asyncio.Queue,
+        num_workers: int,
+        counter: classes.ProgressCounter,
+        reuse: typing.Union[typing.Callable[[dict], bool], None],
+        skip_user_ids: set[int]
+    ) -> None:
+    """
+    Producer; fetches rankings pages (a few at a time) and feeds their userIDs into the queue in page order, as soon
+    as each page arrives.
+    UserIDs in skip_user_ids are dropped (e.g. because they were already fetched before a crash).
+    If reuse is given and returns True for a rankings entry, that user is not refetched.
+    Once every page is done, puts one None per worker to tell them to stop.
+    """
     print(f"Fetching user IDs for rankings pages {first_page}-{first_page + num_pages - 1} ...")
-    counter = classes.ProgressCounter(0, num_pages)
 
-    # Stay under ratelimit by firing request i at time = MAX_REQUESTS_PER_SEC * i (e.g. r1 at 0.0s, r2 at 0.1s, r3 at 0.2s, ...)
-    tasks = [
-        fetch_single_rankings_ids(osu, mode, page, MAX_REQUESTS_PER_SEC * i, counter)
-        for i, page in enumerate(range(first_page, first_page + num_pages))
-    ]
-    results = await asyncio.gather(*tasks)
-    user_ids = [id for ids in results for id in ids]
-    print("\n", end="")
-    return user_ids
+    pages = iter(range(first_page, first_page + num_pages))
+    in_flight = collections.deque(
+        asyncio.create_task(fetch_single_rankings_page(osu, mode, page, limiter))
+        for page in itertools.islice(pages, RANKINGS_PAGES_IN_FLIGHT)
+    )
+
+    try:
+        while in_flight:
+            entries = await in_flight.popleft()
+            next_page = next(pages, None)
+            if next_page is not None:
+                in_flight.append(asyncio.create_task(fetch_single_rankings_page(osu, mode, next_page, limiter)))
+
+            for entry in entries:
+                if entry["user_id"] in skip_user_ids:
+                    counter.increment()
+                    counter.print_progress_bar()
+                    continue
+
+                if reuse is not None and reuse(entry):
+                    counter.increment()
+                    counter.print_progress_bar()
+                else:
+                    await queue.put(entry["user_id"])
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+    for _ in range(num_workers):
+        await queue.put(None)
 
 
 async def fetch_single_user(
         osu: ossapi.OssapiAsync,
         mode: ossapi.GameMode,
         user_id: int,
-        initial_wait_sec: float,
+        limiter: classes.TokenBucket,
         counter: classes.ProgressCounter
     ) -> list[typing.Union[dict, None]]:
     """
     Requests user from osu!API v2.
+    Waits on the shared ratelimiter before each attempt.
     Deals with server errors using [exponential backoff](https://en.wikipedia.org/wiki/Exponential_backoff).
     """
-    await asyncio.sleep(initial_wait_sec)
-
     retries = 0
     wait_sec = 0.0
 
     while True:
         err_msg = ""
         try:
+            # Every attempt (including retries) takes a token, so backoffs don't push us over the ratelimit
+            await limiter.acquire()
+
             # Sometimes ossapi client requests will hang
             user = await asyncio.wait_for(
                 osu.user(
@@ -164,42 +219,102 @@ async def fetch_single_user(
         continue
 
 
-async def fetch_users(osu: ossapi.OssapiAsync, mode: ossapi.GameMode, user_ids: list[typing.Union[dict, None]]) -> list[dict]:
-    print("Fetching user data...")
-    counter = classes.ProgressCounter(0, len(user_ids))
+async def fetch_users_worker(
+        osu: ossapi.OssapiAsync,
+        mode: ossapi.GameMode,
+        limiter: classes.TokenBucket,
+        queue: asyncio.Queue,
+        counter: classes.ProgressCounter,
+        sink: typing.Callable[[dict], None]
+    ) -> None:
+    """
+    Consumer; pulls userIDs off the queue and passes fetched users to sink until it receives None.
+    """
+    while True:
+        user_id = await queue.get()
+        if user_id is None:
+            return
 
-    # Stay under ratelimit by firing request i at time = MAX_REQUESTS_PER_SEC * i (e.g. r1 at 0.0s, r2 at 0.1s, r3 at 0.2s, ...)
-    tasks = [
-        fetch_single_user(osu, mode, user_id, MAX_REQUESTS_PER_SEC * i, counter)
-        for i, user_id in enumerate(user_ids)
-    ]
-    results = await asyncio.gather(*tasks)
-    print("\n", end="")
-    return [user for user in results if user is not None]
+        user = await fetch_single_user(osu, mode, user_id, limiter, counter)
+        if user is not None:
+            sink(user)
+
+
+async def fetch_users(
+        osu: ossapi.OssapiAsync,
+        mode: ossapi.GameMode,
+        first_page: int,
+        num_pages: int,
+        limiter: classes.TokenBucket,
+        sink: typing.Callable[[dict], None],
+        reuse: typing.Union[typing.Callable[[dict], bool], None] = None,
+        skip_user_ids: typing.Union[set[int], None] = None
+    ) -> None:
+    """
+    Fetch every user on the given rankings pages, streaming each one to sink as it completes.
+    Rankings pages feed a bounded queue that a fixed pool of workers consumes from, so user requests start as soon
+    as the first page arrives and only a handful of userIDs are ever held at once.
+    See fetch_rankings_ids for reuse and skip_user_ids.
+    """
+    if skip_user_ids is None:
+        skip_user_ids = set()
 
+    counter = classes.ProgressCounter(0, num_pages * RANKINGS_PAGE_SIZE)
+    queue = asyncio.Queue(maxsize=USER_ID_QUEUE_SIZE)
 
-def save_users(filename: str, users: list[dict]):
-    with open(filename, "wb") as f:
-        pickle.dump({
-            "users": users
-        }, f)
+    producer = fetch_rankings_ids(osu, mode, first_page, num_pages, limiter, queue, NUM_USER_WORKERS, counter, reuse, skip_user_ids)
+    workers = [
+        fetch_users_worker(osu, mode, limiter, queue, counter, sink)
+        for _ in range(NUM_USER_WORKERS)
+    ]
 
+    print("Fetching user data...")
+    await asyncio.gather(producer, *workers)
+    print("\n", end="")
 
-def load_users(filename: str) -> list[dict]:
-    with open(filename, "rb") as f:
-        data = pickle.load(f)
-        users = data["users"]
-        print(f"Successfully loaded data for {len(users)} users!")
-        return users
 
 #################################################################################################################################################
 #################################################################################################################################################
 
-async def scrape_users(start_rank: int, num_users: int, gamemode: ossapi.GameMode, use_last_run: bool, save_filename: str) -> list[dict]:
+def open_store(save_filename: str, legacy_save_filename: str) -> user_store.UserStore:
+    """
+    Open the SQLite savefile at save_filename. If it doesn't hold any users yet but a savefile of an older version (a
+    pickled list of users) is found at legacy_save_filename, its users are imported as the last run.
+    """
+    store = user_store.UserStore(save_filename)
+    if store.count_users() == 0 and os.path.exists(legacy_save_filename):
+        print(f"Importing users from old savefile {legacy_save_filename} into {save_filename}...")
+        with open(legacy_save_filename, "rb") as f:
+            users = pickle.load(f)["users"]
+        num_users = store.import_users(users)
+        print(f"Successfully imported {num_users} users! {legacy_save_filename} is no longer used and can be deleted.")
+    return store
+
+
+async def scrape_users(
+        start_rank: int,
+        num_users: int,
+        gamemode: ossapi.GameMode,
+        use_last_run: bool,
+        save_filename: str,
+        legacy_save_filename: str,
+        requests_per_sec: float,
+        request_burst: int,
+        incremental: bool,
+        incremental_refresh_percent: float,
+        resume: bool
+    ) -> user_store.UserStore:
     """
-    Scrape user data from osu!API.
-    If use_last_run is True, ignores num_users and reads data from save_filename.\n
-    Returns list of users including:
+    Scrape user data from osu!API into the SQLite savefile at save_filename, and return the store. Users saved by an
+    older version at legacy_save_filename are imported first (see open_store).
+    If use_last_run is True, ignores num_users and returns the store as it was left by the previous run.
+    All requests share a token bucket that allows requests_per_sec on average and bursts of up to request_burst.
+    Every scraped user is kept in the store between runs. If incremental is True, users already in the store keep their
+    stored data (with rank refreshed from the rankings pages); only new users, renamed users and the
+    incremental_refresh_percent% least recently fetched users are requested.
+    Users are committed to the store in small batches as they arrive. If resume is True, users scraped by an interrupted
+    scrape with the same parameters are kept and only the missing ones are requested.\n
+    The users of the run can be queried from the store (see user_store.UserStore.iter_last_run_users), including:
         * "user_id": `int`
         * "current_username": `str`
         * "previous_usernames": `list[str]`
@@ -209,9 +324,15 @@ async def scrape_users(start_rank: int, num_users: int, gamemode: ossapi.GameMod
     """
     if use_last_run:
         print(f"\n--- Fetching save data from {save_filename}...")
-        if not os.path.exists(save_filename):
+        if not os.path.exists(save_filename) and not os.path.exists(legacy_save_filename):
             raise FileNotFoundError(f"Savefile {save_filename} could not be found!")
-        return load_users(save_filename)
+
+        store = open_store(save_filename, legacy_save_filename)
+        num_users = store.count_last_run_users()
+        if num_users == 0:
+            raise FileNotFoundError(f"Savefile {save_filename} does not contain a completed run!")
+        print(f"Successfully loaded data for {num_users} users!")
+        return store
 
     if start_rank < 1 or start_rank > 10000:
         raise ValueError(f"Start rank must be between 1-10000!")
@@ -220,8 +341,8 @@ async def scrape_users(start_rank: int, num_users: int, gamemode: ossapi.GameMod
 
     # users ∈ [start_rank, end_rank]
     end_rank = start_rank + num_users - 1
-    start_page = math.ceil(start_rank / 50)
-    end_page = math.ceil(end_rank / 50)
+    start_page = math.ceil(start_rank / RANKINGS_PAGE_SIZE)
+    end_page = math.ceil(end_rank / RANKINGS_PAGE_SIZE)
     num_pages = end_page - start_page + 1
     print(f"\n--- Scraping osu!API data for {num_users} users...")
 
@@ -233,29 +354,50 @@ async def scrape_users(start_rank: int, num_users: int, gamemode: ossapi.GameMod
         os.getenv("OSU_API_CLIENT_ID"),
         os.getenv("OSU_API_CLIENT_SECRET"))
 
-    user_ids = await fetch_rankings_ids(osu, gamemode, start_page, num_pages)
-    users = await fetch_users(osu, gamemode, user_ids)
+    store = open_store(save_filename, legacy_save_filename)
+    run_params = {"start_rank": start_rank, "num_users": num_users, "gamemode": gamemode.value, "incremental": incremental}
+    if resume:
+        print(f"Resume flag was set; loading checkpoint from {save_filename}...")
+        scraped_user_ids = store.resume_run(run_params)
+    else:
+        store.start_run(run_params)
+        scraped_user_ids = set()
 
-    # Remove excess users
-    num_remove_from_front = start_rank - ((start_page - 1) * 50) - 1
-    num_remove_from_back = (end_page * 50) - end_rank
-    print(f"Removing {num_remove_from_back + num_remove_from_front} excess users...")
+    reuse_stored_user = None
+    if incremental:
+        stale_user_ids = store.select_stale_user_ids(start_rank, end_rank, incremental_refresh_percent)
+        print(f"Incremental flag was set; reusing stored users except for the {len(stale_user_ids)} least recently fetched...")
 
-    users = [u for u in sorted(users, key=lambda user: (user["global_rank"]), reverse=False)]
-    if num_remove_from_front != 0:
-        users = users[num_remove_from_front:]
-    if num_remove_from_back != 0:
-        users = users[:-num_remove_from_back]
+        def reuse_stored_user(entry: dict) -> bool:
+            if entry["user_id"] in stale_user_ids:
+                return False
 
-    # assert len([u["global_rank"] for u in users]) == num_users
-    # assert min([u["global_rank"] for u in users]) == start_rank
-    # assert max([u["global_rank"] for u in users]) == end_rank
+            # New users aren't stored yet, and renamed users need their previous usernames refetched
+            if store.get_current_username(entry["user_id"]) != entry["current_username"]:
+                return False
+
+            store.add_reused_user(entry["user_id"], entry["global_rank"])
+            return True
+
+    limiter = classes.TokenBucket(requests_per_sec, request_burst)
+    try:
+        await fetch_users(osu, gamemode, start_page, num_pages, limiter, store.add_fetched_user, reuse_stored_user, scraped_user_ids)
+    finally:
+        # Keep whatever was scraped before a crash so that it can be resumed
+        store.flush()
+
+    print(f"Fetched {store.num_fetched} users ({store.num_changed} previously stored users changed their about me page), reused {store.num_reused}.")
+
+    # Remove excess users
+    num_remove_from_front = start_rank - ((start_page - 1) * RANKINGS_PAGE_SIZE) - 1
+    num_remove_from_back = (end_page * RANKINGS_PAGE_SIZE) - end_rank
+    print(f"Removing {num_remove_from_back + num_remove_from_front} excess users...")
+    store.finish_run(num_remove_from_front, num_remove_from_back)
 
     # Turn it back on now that we're done with the noisy stuff
     logging.getLogger("asyncio").setLevel(asyncio_default_log_level)
 
-    save_users(save_filename, users)
-    return users
+    return store
 
 #################################################################################################################################################
 #################################################################################################################################################
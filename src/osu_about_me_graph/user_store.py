@@ -0,0 +1,312 @@
+import hashlib
+import json
+import math
+import sqlite3
+import time
+import typing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    current_username TEXT NOT NULL,
+    about_me TEXT NOT NULL,
+    follower_count INTEGER,
+    global_rank INTEGER,
+    fetched_at REAL NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_current_username ON users (current_username);
+CREATE INDEX IF NOT EXISTS users_global_rank ON users (global_rank);
+
+CREATE TABLE IF NOT EXISTS aliases (
+    user_id INTEGER NOT NULL REFERENCES users (user_id),
+    position INTEGER NOT NULL,
+    alias TEXT NOT NULL,
+    PRIMARY KEY (user_id, position)
+);
+CREATE INDEX IF NOT EXISTS aliases_alias ON aliases (alias);
+
+CREATE TABLE IF NOT EXISTS last_run (
+    user_id INTEGER PRIMARY KEY REFERENCES users (user_id),
+    global_rank INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS checkpoint (
+    user_id INTEGER PRIMARY KEY REFERENCES users (user_id),
+    global_rank INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Scraped users are buffered and written in one transaction per batch. A crash loses at most one batch.
+INSERT_BATCH_SIZE = 50
+
+# Same order parse_users has always processed users in; follower count (descending), then rank (ascending) in the case of ties
+LAST_RUN_ORDER = "ORDER BY users.follower_count DESC, last_run.global_rank ASC, users.user_id ASC"
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def hash_about_me(about_me: str) -> str:
+    return hashlib.sha256(about_me.encode("utf-8")).hexdigest()
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+class UserStore:
+    """
+    SQLite-backed storage for scraped users.
+    * users/aliases: latest data of every user ever scraped, with when they were fetched and a hash of their about me page.
+    * checkpoint: users scraped so far by the current (possibly interrupted) scrape.
+    * last_run: users of the most recent completed scrape, i.e. what every stage after scraping works with.
+
+    Stages query only the columns they need rather than loading every about me page up front.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+
+        self.pending_users = []
+        self.pending_reused = []
+        self.num_fetched = 0
+        self.num_changed = 0
+        self.num_reused = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+    #############################################################################################################################################
+    # Scraping
+
+    def start_run(self, params: dict) -> None:
+        """
+        Begin a new scrape, throwing away the checkpoint of any previous one.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM checkpoint")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('checkpoint_params', ?)", (json.dumps(params),))
+
+    def resume_run(self, params: dict) -> set[int]:
+        """
+        Continue an interrupted scrape with the same parameters. Returns the userIDs it already scraped.
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'checkpoint_params'").fetchone()
+        if row is None:
+            raise FileNotFoundError(f"No checkpoint could be found in {self.filename}!")
+
+        checkpoint_params = json.loads(row[0])
+        if checkpoint_params != params:
+            raise ValueError(f"Checkpoint in {self.filename} was made with different parameters! Expected {params}, found {checkpoint_params}")
+
+        user_ids = {user_id for (user_id,) in self.conn.execute("SELECT user_id FROM checkpoint")}
+        print(f"Successfully loaded {len(user_ids)} users from checkpoint!")
+        return user_ids
+
+    def add_fetched_user(self, user: dict) -> None:
+        self.pending_users.append((user, time.time()))
+        if len(self.pending_users) >= INSERT_BATCH_SIZE:
+            self.flush()
+
+    def add_reused_user(self, user_id: int, global_rank: int) -> None:
+        self.pending_reused.append((user_id, global_rank))
+        if len(self.pending_reused) >= INSERT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write buffered users to the database in a single transaction.
+        """
+        if not self.pending_users and not self.pending_reused:
+            return
+
+        users = self.pending_users
+        reused = self.pending_reused
+        self.pending_users = []
+        self.pending_reused = []
+
+        user_ids = [user["user_id"] for user, _ in users]
+        placeholders = ",".join("?" * len(user_ids))
+        old_hashes = dict(self.conn.execute(f"SELECT user_id, content_hash FROM users WHERE user_id IN ({placeholders})", user_ids))
+
+        rows = []
+        for user, fetched_at in users:
+            content_hash = hash_about_me(user["about_me"])
+            if user["user_id"] in old_hashes and old_hashes[user["user_id"]] != content_hash:
+                self.num_changed += 1
+            rows.append((
+                user["user_id"],
+                user["current_username"],
+                user["about_me"],
+                user["follower_count"],
+                user["global_rank"],
+                fetched_at,
+                content_hash
+            ))
+
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO users (user_id, current_username, about_me, follower_count, global_rank, fetched_at, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    current_username = excluded.current_username,
+                    about_me = excluded.about_me,
+                    follower_count = excluded.follower_count,
+                    global_rank = excluded.global_rank,
+                    fetched_at = excluded.fetched_at,
+                    content_hash = excluded.content_hash
+                """,
+                rows
+            )
+            self.conn.executemany("DELETE FROM aliases WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+            self.conn.executemany(
+                "INSERT INTO aliases (user_id, position, alias) VALUES (?, ?, ?)",
+                [
+                    (user["user_id"], position, alias)
+                    for user, _ in users
+                    for position, alias in enumerate(user["previous_usernames"])
+                ]
+            )
+            self.conn.executemany("UPDATE users SET global_rank = ? WHERE user_id = ?", [(rank, user_id) for user_id, rank in reused])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO checkpoint (user_id, global_rank) VALUES (?, ?)",
+                [(user["user_id"], user["global_rank"]) for user, _ in users] + reused
+            )
+
+        self.num_fetched += len(users)
+        self.num_reused += len(reused)
+
+    def finish_run(self, num_remove_from_front: int, num_remove_from_back: int) -> int:
+        """
+        Turn the checkpoint into the new last run, sorted by rank and with excess users removed from either end.
+        Returns the number of users in the last run.
+        """
+        self.flush()
+        with self.conn:
+            (num_scraped,) = self.conn.execute("SELECT COUNT(*) FROM checkpoint").fetchone()
+            self.conn.execute("DELETE FROM last_run")
+            self.conn.execute(
+                """
+                INSERT INTO last_run (user_id, global_rank)
+                SELECT user_id, global_rank FROM checkpoint ORDER BY global_rank ASC, user_id ASC LIMIT ? OFFSET ?
+                """,
+                (max(0, num_scraped - num_remove_from_front - num_remove_from_back), num_remove_from_front)
+            )
+            self.conn.execute("DELETE FROM checkpoint")
+            self.conn.execute("DELETE FROM meta WHERE key = 'checkpoint_params'")
+
+        return self.count_last_run_users()
+
+    def import_users(self, users: list[dict]) -> int:
+        """
+        Store users saved by an older version (in the same format as add_fetched_user takes) and make them the last run.
+        Returns the number of users in the last run.
+        """
+        self.start_run({"imported": True})
+        for user in users:
+            self.add_fetched_user(user)
+        num_users = self.finish_run(0, 0)
+
+        # They weren't fetched by this run
+        self.num_fetched = 0
+        self.num_changed = 0
+        return num_users
+
+    def count_users(self) -> int:
+        (num_users,) = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        return num_users
+
+    def get_current_username(self, user_id: int) -> typing.Union[str, None]:
+        row = self.conn.execute("SELECT current_username FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def select_stale_user_ids(self, start_rank: int, end_rank: int, refresh_percent: float) -> set[int]:
+        """
+        Pick the least recently fetched X% of stored users that were last seen in [start_rank, end_rank].
+        Since every refetch bumps fetched_at, repeated incremental runs rotate through the whole rank window.
+        """
+        (num_in_window,) = self.conn.execute(
+            "SELECT COUNT(*) FROM users WHERE global_rank BETWEEN ? AND ?",
+            (start_rank, end_rank)
+        ).fetchone()
+
+        num_stale = math.ceil(num_in_window * (refresh_percent / 100))
+        rows = self.conn.execute(
+            "SELECT user_id FROM users WHERE global_rank BETWEEN ? AND ? ORDER BY fetched_at ASC LIMIT ?",
+            (start_rank, end_rank, num_stale)
+        )
+        return {user_id for (user_id,) in rows}
+
+    #############################################################################################################################################
+    # Querying the last run
+
+    def count_last_run_users(self) -> int:
+        (num_users,) = self.conn.execute("SELECT COUNT(*) FROM last_run").fetchone()
+        return num_users
+
+    def load_last_run_previous_usernames(self) -> dict[int, list[str]]:
+        previous_usernames = {}
+        rows = self.conn.execute(
+            """
+            SELECT aliases.user_id, aliases.alias FROM aliases
+            JOIN last_run ON last_run.user_id = aliases.user_id
+            ORDER BY aliases.user_id, aliases.position
+            """
+        )
+        for user_id, alias in rows:
+            previous_usernames.setdefault(user_id, []).append(alias)
+        return previous_usernames
+
+    def iter_last_run_users(self, include_about_me: bool) -> typing.Iterator[dict]:
+        """
+        Stream users of the last run, in the same format as scrape_users used to return them.
+        If include_about_me is False, the (potentially large) "about_me" field is left out.
+        """
+        previous_usernames = self.load_last_run_previous_usernames()
+        about_me_column = "users.about_me" if include_about_me else "NULL"
+        rows = self.conn.execute(
+            f"""
+            SELECT users.user_id, users.current_username, {about_me_column}, users.follower_count, last_run.global_rank
+            FROM users JOIN last_run ON last_run.user_id = users.user_id
+            {LAST_RUN_ORDER}
+            """
+        )
+        for user_id, current_username, about_me, follower_count, global_rank in rows:
+            user = {
+                "user_id": user_id,
+                "current_username": current_username,
+                "previous_usernames": previous_usernames.get(user_id, []),
+                "follower_count": follower_count,
+                "global_rank": global_rank
+            }
+            if include_about_me:
+                user["about_me"] = about_me
+            yield user
+
+    def load_last_run_summaries(self) -> list[dict]:
+        """
+        Load users of the last run without their about me pages.
+        """
+        return list(self.iter_last_run_users(include_about_me=False))
+
+    def iter_last_run_about_me(self) -> typing.Iterator[tuple[str, str, str]]:
+        """
+        Stream (current username, content hash, about me) of the last run, in the same order as iter_last_run_users.
+        """
+        rows = self.conn.execute(
+            f"""
+            SELECT users.current_username, users.content_hash, users.about_me
+            FROM users JOIN last_run ON last_run.user_id = users.user_id
+            {LAST_RUN_ORDER}
+            """
+        )
+        yield from rows
+
+#################################################################################################################################################
+#################################################################################################################################################
@@ -0,0 +1,55 @@
+from src.osu_about_me_graph import classes
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def build_matcher() -> classes.CompactTrie:
+    matcher = classes.CompactTrie()
+    for alias in ["cookiezi", "shigetora", "users/124493"]:
+        matcher.insert(alias)
+    matcher.build()
+    return matcher
+
+
+def test_load_round_trip(tmp_path):
+    filename = str(tmp_path / "matcher.bin")
+    build_matcher().save(filename, "fingerprint")
+
+    loaded = classes.CompactTrie.load(filename, "fingerprint")
+    assert loaded is not None
+    assert loaded.find_names_in_document("Cookiezi, not shigetorax") == {"cookiezi"}
+    assert classes.CompactTrie.load(filename, "other fingerprint") is None
+
+
+def test_load_unusable_files(tmp_path):
+    """
+    Files that can't be used are treated like missing ones, so that the caller rebuilds the matcher.
+    """
+    filename = str(tmp_path / "matcher.bin")
+    assert classes.CompactTrie.load(filename, "fingerprint") is None
+
+    build_matcher().save(filename, "fingerprint")
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    for broken in [b"", data[:10], data[:-4], b"\xff" * len(data)]:
+        with open(filename, "wb") as f:
+            f.write(broken)
+        assert classes.CompactTrie.load(filename, "fingerprint") is None
+
+
+def test_save_replaces_file(tmp_path):
+    """
+    Saving over a file that is memory-mapped leaves the mapped tree intact, and no temporary file behind.
+    """
+    filename = str(tmp_path / "matcher.bin")
+    build_matcher().save(filename, "fingerprint")
+    loaded = classes.CompactTrie.load(filename, "fingerprint")
+
+    other = classes.CompactTrie()
+    other.insert("whitecat")
+    other.save(filename, "other fingerprint")
+
+    assert loaded.find_names_in_document("cookiezi and whitecat") == {"cookiezi"}
+    assert classes.CompactTrie.load(filename, "other fingerprint").find_names_in_document("cookiezi and whitecat") == {"whitecat"}
+    assert [path.name for path in tmp_path.iterdir()] == ["matcher.bin"]
@@ -0,0 +1,200 @@
+from src.osu_about_me_graph import classes
+
+import pytest
+
+import pickle
+import random
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+class ReferenceTrieNode:
+    """
+    Prefix tree node.
+    """
+    def __init__(self):
+        self.children = {}
+        self.is_end_of_word = False
+
+class ReferenceTrie:
+    """
+    Prefix tree. The matcher that classes.CompactTrie replaced, kept as-is for reference.
+    """
+    def __init__(self):
+        self.root = ReferenceTrieNode()
+
+    def insert(self, word: str) -> None:
+        node = self.root
+        for char in word.lower():
+            if char not in node.children:
+                node.children[char] = ReferenceTrieNode()
+            node = node.children[char]
+        node.is_end_of_word = True
+
+    def find_names_in_document(self, document: str) -> set[str]:
+        """
+        Return set of names from prefix tree that appear in given document.
+        """
+        document = document.lower()
+        found_names = set()
+
+        for i in range(len(document)):
+            if i > 0 and document[i-1].isalnum():
+                continue
+
+            node = self.root
+            j = i
+
+            matched_name = None
+
+            while j < len(document) and document[j] in node.children:
+                node = node.children[document[j]]
+                j += 1
+
+                if node.is_end_of_word:
+                    if j == len(document) or not document[j].isalnum():
+                        matched_name = document[i:j]
+
+            if matched_name:
+                found_names.add(matched_name)
+
+        return found_names
+
+    def get_all_words(self) -> list[str]:
+        """
+        Return all words stored in the prefix tree.
+        """
+        words = []
+        def dfs(node: ReferenceTrieNode, current_word: str) -> None:
+            if node.is_end_of_word:
+                words.append(current_word)
+
+            for char, child in node.children.items():
+                dfs(child, current_word + char)
+
+        dfs(self.root, "")
+        return sorted(words)
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+SYLLABLES = ["ka", "to", "mi", "ra", "ne", "su", "lo", "vi", "x", "ze", "pa", "qu", "do", "ri", "an", "el", "wo", "ing"]
+COMMON_WORDS = "the a to and i my of in is for you it with this on play osu love hello anime wooting 400 hddt".split()
+
+# Pages that trip up matchers: aliases next to punctuation or other letters, overlapping aliases, unicode that changes
+# length when lowercased ("İ"), characters outside the BMP, and aliases at the very start and end of the page
+HANDWRITTEN_PAGES = [
+    "",
+    "cookiezi",
+    "Cookiezi!",
+    "xcookiezi cookiezix cookiezi_ -cookiezi- [cookiezi]",
+    "big fan of shigetora and chocomint, also Shige",
+    "İcookiezi İ cookiezi İİ",
+    "🎵 cookiezi 🎵cookiezi🎵 𝔠ookiezi",
+    "my friend -gn and -GN, not x-gn",
+    "users/124493 and osu.ppy.sh/users/124493/ and users/1244930",
+    "ka to ka-to kato kato1 ka to mi\nka\tto",
+    "whitecat\nmrekk\r\nvaxei",
+    "ÀÉÎõü straße STRASSE ǅ ǈ",
+    "[ka] ka] [ka [[ka]]",
+]
+
+ALIASES = [
+    "cookiezi", "shigetora", "chocomint", "shige", "-gn", "x-gn", "users/124493", "ka", "to", "ka to", "ka-to", "kato",
+    "ka to mi", "whitecat", "mrekk", "vaxei", "[ka]", "ka]", "i̇cookiezi", "strasse", "straße", "ǆ"
+]
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+@pytest.fixture(scope="module")
+def corpus() -> tuple[list[str], list[str]]:
+    """
+    Aliases (like current and previous usernames, and users/<id>) and about me pages mentioning them, generated with a
+    fixed seed, plus the handwritten ones above.
+    """
+    rng = random.Random(727)
+
+    aliases = set(ALIASES)
+    for user_id in range(3000):
+        name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+        if rng.random() < 0.3:
+            name += str(rng.randint(0, 999))
+        if rng.random() < 0.1:
+            name += rng.choice([" ", "_", "-"]) + rng.choice(SYLLABLES)
+        aliases.add(name)
+        aliases.add(f"users/{1000 + user_id}")
+    alias_list = sorted(aliases)
+
+    pages = list(HANDWRITTEN_PAGES)
+    separators = [" ", " ", " ", "\n", ", ", "!", "@", "/", "İ", "🎵", "x", "_"]
+    for _ in range(500):
+        words = []
+        for _ in range(rng.randint(0, 200)):
+            word = rng.choice(alias_list) if rng.random() < 0.2 else rng.choice(COMMON_WORDS)
+            if rng.random() < 0.1:
+                word = word.upper()
+            words.append(word)
+            words.append(rng.choice(separators))
+        pages.append("".join(words))
+    return alias_list, pages
+
+
+def build_matchers(aliases: list[str], tmp_path) -> tuple[ReferenceTrie, list[classes.CompactTrie]]:
+    """
+    The reference trie, and the compact matcher as built, after a pickle round trip, and memory-mapped from a file.
+    """
+    trie = ReferenceTrie()
+    matcher = classes.CompactTrie()
+    for alias in aliases:
+        trie.insert(alias)
+        matcher.insert(alias)
+    matcher.build()
+
+    filename = str(tmp_path / "matcher.bin")
+    matcher.save(filename, "fingerprint")
+    loaded = classes.CompactTrie.load(filename, "fingerprint")
+    assert loaded is not None
+    return trie, [matcher, pickle.loads(pickle.dumps(matcher)), loaded]
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def test_find_names_in_document(corpus, tmp_path):
+    (aliases, pages) = corpus
+    (trie, matchers) = build_matchers(aliases, tmp_path)
+
+    expected = [trie.find_names_in_document(page) for page in pages]
+    assert any(expected)
+    for matcher in matchers:
+        assert [matcher.find_names_in_document(page) for page in pages] == expected
+
+        # All pages searched at once, as parse_users does
+        batched_matches = matcher.find_matches_many(pages)
+        assert [set(matcher.first_longest_matches(page.lower(), matches)) for page, matches in zip(pages, batched_matches)] == expected
+
+
+def test_get_all_words(corpus, tmp_path):
+    (aliases, _) = corpus
+    (trie, matchers) = build_matchers(aliases, tmp_path)
+
+    for matcher in matchers:
+        assert matcher.get_all_words() == trie.get_all_words()
+
+
+def test_dense_overlapping_aliases(tmp_path):
+    """
+    Tiny alphabets, so that aliases overlap and nest as much as possible.
+    """
+    rng = random.Random(1)
+    alphabet = "ab c-1é_İ[]"
+    for trial in range(200):
+        aliases = {"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 5))) for _ in range(rng.randint(1, 15))}
+        (trie, matchers) = build_matchers(sorted(aliases), tmp_path)
+        for _ in range(5):
+            page = "".join(rng.choice(alphabet + "AB\n") for _ in range(rng.randint(0, 60)))
+            expected = trie.find_names_in_document(page)
+            for matcher in matchers:
+                assert matcher.find_names_in_document(page) == expected, (aliases, page)
+        for matcher in matchers:
+            assert matcher.get_all_words() == trie.get_all_words()
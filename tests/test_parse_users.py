@@ -0,0 +1,53 @@
+from src.osu_about_me_graph import classes
+from src.osu_about_me_graph import parse_users
+from src.osu_about_me_graph import user_store
+
+import json
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+# "İ" lowercases into two characters and "🎵" takes up two UTF-16 code units, so both shift offsets in the page
+ABOUT_ME = "İİ 🎵 hi COOKIEZI and İ [b]shigetora[/b]🎵mrekk"
+
+USERS = [
+    {"user_id": 1, "current_username": "whitecat", "previous_usernames": [], "about_me": ABOUT_ME, "follower_count": 3, "global_rank": 3},
+    {"user_id": 2, "current_username": "cookiezi", "previous_usernames": ["shigetora"], "about_me": "", "follower_count": 2, "global_rank": 2},
+    {"user_id": 3, "current_username": "mrekk", "previous_usernames": [], "about_me": "", "follower_count": 1, "global_rank": 1}
+]
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def test_save_to_json_offsets(tmp_path):
+    store = user_store.UserStore(str(tmp_path / "users.db"))
+    store.import_users(USERS)
+
+    mentions_graph = classes.DirectedGraph()
+    mention_index = classes.MentionIndex()
+    for user in USERS:
+        mentions_graph.add_vertex(user["current_username"])
+
+    # Found in the lowercased page, as parse_users does
+    lowered = ABOUT_ME.lower()
+    for mentioned, alias in [("cookiezi", "cookiezi"), ("cookiezi", "shigetora"), ("mrekk", "mrekk")]:
+        mentions_graph.add_edge("whitecat", mentioned)
+        mention_index.add_mention("whitecat", mentioned, alias, lowered.index(alias), "")
+
+    json_filename = str(tmp_path / "graph_data.json")
+    parse_users.save_to_json(mentions_graph, mention_index, store, [], json_filename)
+    store.close()
+
+    with open(json_filename, encoding="utf-8") as f:
+        data = json.load(f)
+
+    # Slice the page like JavaScript would
+    (node,) = [node for node in data["nodes"] if node["data"]["id"] == "whitecat"]
+    utf16_page = node["data"]["about_me"].encode("utf-16-le")
+    found = set()
+    for edge in data["edges"]:
+        for mention in edge["data"]["mentions"]:
+            text = utf16_page[2 * mention["offset"]:2 * (mention["offset"] + mention["length"])].decode("utf-16-le")
+            assert text.lower() == mention["alias"]
+            found.add(text)
+    assert found == {"COOKIEZI", "shigetora", "mrekk"}
@@ -0,0 +1,53 @@
+from src.osu_about_me_graph import scrape_users
+
+import pickle
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+USERS = [
+    {
+        "user_id": 124493,
+        "current_username": "cookiezi",
+        "previous_usernames": ["shigetora", "chocomint"],
+        "about_me": "",
+        "follower_count": 300000,
+        "global_rank": 2
+    },
+    {
+        "user_id": 7562902,
+        "current_username": "mrekk",
+        "previous_usernames": [],
+        "about_me": "hi [b]cookiezi[/b]",
+        "follower_count": 200000,
+        "global_rank": 1
+    }
+]
+
+#################################################################################################################################################
+#################################################################################################################################################
+
+def test_import_legacy_savefile(tmp_path):
+    legacy_save_filename = str(tmp_path / "users.pkl")
+    save_filename = str(tmp_path / "users.db")
+    with open(legacy_save_filename, "wb") as f:
+        pickle.dump({"users": USERS}, f)
+
+    store = scrape_users.open_store(save_filename, legacy_save_filename)
+    assert list(store.iter_last_run_users(include_about_me=True)) == USERS
+    assert store.num_fetched == 0
+    store.close()
+
+    # Only imported into an empty savefile
+    with open(legacy_save_filename, "wb") as f:
+        pickle.dump({"users": USERS[:1]}, f)
+    store = scrape_users.open_store(save_filename, legacy_save_filename)
+    assert store.count_last_run_users() == 2
+    store.close()
+
+
+def test_no_legacy_savefile(tmp_path):
+    store = scrape_users.open_store(str(tmp_path / "users.db"), str(tmp_path / "users.pkl"))
+    assert store.count_users() == 0
+    assert store.count_last_run_users() == 0
+    store.close()